@@ -6,11 +6,20 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.pool import Pool
-from .async import Async, ResultOptions, async_task    # noqa
+from .async import Async, ResultOptions, QueueStats, async_task, \
+    SoftTimeLimitExceeded, TimeLimitExceeded, UnknownTask, \
+    IncompleteResult, QueueFull    # noqa
+from .schedule import ScheduledTask
+from .workflow import Chord, ChordResult
+from .cache import ResultCache
 
 
 def register():
     Pool.register(
         Async,
+        ScheduledTask,
+        Chord,
+        ChordResult,
+        ResultCache,
         module='async_sqs', type_='model'
     )
@@ -11,19 +11,28 @@
     :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) LTD
     :license: 3-clause BSD License, see COPYRIGHT for more details
 """
+import os
 import time
+import math
+import hashlib
+import inspect
 import logging
 from uuid import uuid4
 from collections import namedtuple
 from datetime import datetime, timedelta
 
 import wrapt
-import boto
 from trytond.config import CONFIG
 from trytond.pool import PoolMeta, Pool
 from trytond.model import ModelView, Model
 from trytond.transaction import Transaction
 from .serialization import json, JSONDecoder, JSONEncoder
+from .schedule import MAX_DELAY_SECONDS
+from .cache import MemoryResultCache
+from .transport import SQLiteTransport
+from .eager import EagerResults, EagerExecutor
+from .tracing import Span, NullSpan, FileExporter
+from .ratelimit import TokenBucket, parse_rate
 
 
 __metaclass__ = PoolMeta
@@ -31,19 +40,86 @@ __metaclass__ = PoolMeta
 logger = logging.getLogger('AsyncSQS')
 
 
-if 'sqs_region' in CONFIG.options:  # noqa
-    # If a region is specified for SQS use that
-    boto.sqs.connect_to_region(CONFIG.options['sqs_region'])
+class SoftTimeLimitExceeded(Exception):
+    """
+    Raised inside a task which runs longer than its soft time limit, so
+    that it can clean up.
+    """
+
+
+class TimeLimitExceeded(Exception):
+    """
+    Raised inside a task abandoned by the worker for running longer than
+    its time limit.
+    """
+
+
+class UnknownTask(Exception):
+    """
+    Raised for a task whose model or method does not exist, or which is not
+    decorated with :class:`async_task` when only those are allowed.
+    """
+
+
+class IncompleteResult(Exception):
+    """
+    Raised while reading the streamed result of a generator task which
+    failed before its last item, or whose next chunk did not arrive in
+    time.
+    """
+
+
+class QueueFull(Exception):
+    """
+    Raised when a low priority task is deferred to a queue whose backlog
+    is past its high watermark, and backpressure sheds the task or blocked
+    for too long (see :meth:`Async.apply_backpressure`).
+    """
 
 
 class async_task(object):
 
-    def __init__(self, ignore_result=True, visibility_timeout=60):
+    #: Names of the decorated methods, to find them in the pool quickly
+    method_names = set()
+
+    def __init__(self, ignore_result=True, visibility_timeout=60, queue=None,
+                 chunk_size=100, cache_ttl=None, time_limit=None,
+                 soft_time_limit=None, message_group=None, deduplicate=False,
+                 low_priority=False, rate_limit=None):
         self.ignore_result = ignore_result
         self.visibility_timeout = visibility_timeout
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.cache_ttl = cache_ttl
+        self.time_limit = time_limit
+        self.soft_time_limit = soft_time_limit
+        # Function of the payload returning the message group of the task
+        # on FIFO queues (see Async.get_message_ids)
+        self.message_group = message_group
+        self.deduplicate = deduplicate
+        # Low priority tasks are held back when their queue is backlogged
+        self.low_priority = low_priority
+        # Tasks deferred per second by a process, as a number or a string
+        # like 10/s or 100/m
+        self.rate_limit = rate_limit
+        self.bucket = rate_limit and TokenBucket(parse_rate(rate_limit))
+
+    @property
+    def result_options(self):
+        return ResultOptions(
+            self.ignore_result,
+            self.visibility_timeout,
+            self.chunk_size,
+        )
 
-    @wrapt.decorator
-    def __call__(self, wrapped, instance, args, kwargs):
+    def __call__(self, wrapped):
+        # Methods decorated before classmethod have no name of their own
+        async_task.method_names.add(
+            getattr(wrapped, '__func__', wrapped).__name__
+        )
+        return TaskFunctionWrapper(wrapped, self.wrapper, self)
+
+    def wrapper(self, wrapped, instance, args, kwargs):
         if kwargs.pop('_defer_', False) is False:
             return wrapped(*args, **kwargs)
 
@@ -61,13 +137,41 @@ class async_task(object):
             instance=active_record,
             args=args,
             kwargs=kwargs,
-            result_options=ResultOptions(
-                self.ignore_result,
-                self.visibility_timeout,
-            )
+            result_options=self.result_options,
+            queue=self.queue,
+            cache_ttl=self.cache_ttl,
+            time_limit=self.time_limit,
+            soft_time_limit=self.soft_time_limit,
         )
 
 
+class BoundTaskFunctionWrapper(wrapt.BoundFunctionWrapper):
+    """
+    A task bound to its model or record
+    """
+
+    def defer(self, *args, **kwargs):
+        """
+        Defer the task, like calling it with `_defer_=True`::
+
+            Pool().get('report.bigreport').expensive_method.defer(1, 2)
+        """
+        kwargs['_defer_'] = True
+        return self(*args, **kwargs)
+
+
+class TaskFunctionWrapper(wrapt.FunctionWrapper):
+    """
+    A method decorated with :class:`async_task`, which keeps the decorator
+    for the registry of tasks (see :meth:`Async.get_tasks`).
+    """
+    __bound_function_wrapper__ = BoundTaskFunctionWrapper
+
+    def __init__(self, wrapped, wrapper, task):
+        super(TaskFunctionWrapper, self).__init__(wrapped, wrapper)
+        self._self_task = task
+
+
 class AsyncResult(object):
     """
     A Class that represents an asynchronous result
@@ -76,61 +180,260 @@ class AsyncResult(object):
     """
     def __init__(self, payload):
         self.result_uuid = payload['__result_uuid__']
-        self.result_options = ResultOptions._make(
-            payload['__result_options__']
-        )
+        self.result_options = ResultOptions(*payload['__result_options__'])
+        self.cache = payload.get('__cache__')
         self.result = None
+        self.done = False
 
     def wait(self, wait_time_seconds=None, interval_seconds=1):
         """
         Blockingly wait for the results for wait_time_seconds
+
+        The result of a generator task is returned as a list once all of
+        it has been received. :class:`IncompleteResult` is raised if the
+        task fails, or if the chunks stop arriving, after the first one.
         """
         Async = Pool().get('async.async')
 
-        if self.result_options.ignore_result:
-            raise Async.raise_user_error(
-                'Cannot fetch result for tasks where results are ignored'
-            )
+        self.check_result()
 
-        if self.result:
+        if self.done:
             # If the result is already cached, just return that
             return self.result
 
-        if wait_time_seconds:
-            end_time = datetime.utcnow() + timedelta(
-                seconds=wait_time_seconds
-            )
-        else:
-            end_time = datetime.max
+        if Async.get_eager_mode():
+            return self.wait_eager(wait_time_seconds)
 
-        while datetime.utcnow() < end_time:
-            queue = Async.get_queue(self.result_uuid)
-            if queue:
-                break
-            else:
-                time.sleep(interval_seconds)
-        else:
+        end_time = self.get_end_time(wait_time_seconds)
+        queue = self.get_result_queue(end_time, interval_seconds)
+        if queue is None:
             return None
 
-        results = Async.get_sqs_connection().receive_message(
+        results = Async.get_transport().receive_message(
             queue, wait_time_seconds=wait_time_seconds,
         )
 
         if results:
-            # The queue's purpose in life is over :(
-            queue.delete()
+            message = Async.deserialize_message(results[0].get_body())
+            if 'seq' in message:
+                # Streamed by a generator task
+                results[0].delete()
+                self.result = list(
+                    self.iter_chunks(queue, [message], end_time)
+                )
+            else:
+                # The queue's purpose in life is over :(
+                queue.delete()
+                self.result = message['result']
+                self.cache_result()
+            self.done = True
 
-            self.result = Async.deserialize_message(
-                results[0].get_body()
-            )['result']
+        return self.result
 
+    def wait_eager(self, wait_time_seconds=None):
+        """
+        Wait for the result of a task executed in the process. The
+        exception of a task which failed in a thread is raised.
+        """
+        Async = Pool().get('async.async')
+
+        found, result = Async._eager_results.pop(
+            self.result_uuid, wait_time_seconds
+        )
+        if found:
+            self.result = result
+            self.done = True
         return self.result
 
+    def cache_result(self):
+        """
+        Keep the result of a cached task in the cache of this process.
+        Shared caches are filled by the worker.
+        """
+        Async = Pool().get('async.async')
+
+        cache = Async.get_result_cache()
+        if self.cache and not cache.shared:
+            key, ttl = self.cache
+            cache.set(key, Async.serialize_payload(self.result), ttl)
+
+    def iter_results(self, wait_time_seconds=None, interval_seconds=1):
+        """
+        Iterate over the items of the result of a generator task as they
+        are received, waiting at most wait_time_seconds for each chunk.
+        """
+        Async = Pool().get('async.async')
+
+        self.check_result()
+
+        if not self.done and Async.get_eager_mode():
+            # Executed in the process, the items come all at once
+            self.wait_eager(wait_time_seconds)
+            if not self.done:
+                return
+
+        if self.done:
+            for item in self.result:
+                yield item
+            return
+
+        queue = self.get_result_queue(
+            self.get_end_time(wait_time_seconds), interval_seconds
+        )
+        if queue is None:
+            return
+
+        for item in self.iter_chunks(queue, [], None, wait_time_seconds):
+            yield item
+
+    __iter__ = iter_results
+
+    def iter_chunks(self, queue, messages, end_time, wait_time_seconds=None):
+        """
+        Yield the items of the chunks sent to the result queue, in the
+        order in which they were produced, and delete the queue once the
+        last one is received.
+
+        Raises :class:`IncompleteResult` if the task failed while producing
+        the items, or if a chunk is not received in time.
+
+        :param messages: Messages already received from the queue
+        :param end_time: Time after which to stop waiting for chunks. If
+                         None, wait at most wait_time_seconds per chunk.
+        """
+        pending = dict((message['seq'], message) for message in messages)
+        seq = 0
+        while True:
+            while seq in pending:
+                message = pending.pop(seq)
+                if message.get('end'):
+                    queue.delete()
+                    return
+                if 'error' in message:
+                    queue.delete()
+                    raise IncompleteResult(message['error'])
+                for item in message['chunk']:
+                    yield item
+                seq += 1
+
+            received = self.receive_chunks(
+                queue, end_time or self.get_end_time(wait_time_seconds)
+            )
+            if not received:
+                raise IncompleteResult(
+                    'Timed out waiting for chunk %d of result %s' % (
+                        seq, self.result_uuid
+                    )
+                )
+            for message in received:
+                if 'seq' not in message:
+                    # Not a generator task, the result came in one piece
+                    queue.delete()
+                    for item in message['result']:
+                        yield item
+                    return
+                pending[message['seq']] = message
+
+    def receive_chunks(self, queue, end_time):
+        """
+        Receive and delete the next messages of the result queue, waiting
+        for them until end_time.
+        """
+        Async = Pool().get('async.async')
+        connection = Async.get_transport()
+
+        received = []
+        while not received and datetime.utcnow() < end_time:
+            received = connection.receive_message(
+                queue, number_messages=10, wait_time_seconds=min(
+                    20, max(1, self.get_seconds_left(end_time))
+                ),
+            )
+        if received:
+            connection.delete_message_batch(queue, received)
+        return [
+            Async.deserialize_message(result.get_body())
+            for result in received
+        ]
+
+    def check_result(self):
+        """
+        Raise an error if the result of the task is not sent back
+        """
+        Async = Pool().get('async.async')
+
+        if self.result_options.ignore_result:
+            raise Async.raise_user_error(
+                'Cannot fetch result for tasks where results are ignored'
+            )
+
+    def get_result_queue(self, end_time, interval_seconds):
+        """
+        Wait until end_time for the result queue to be created and return
+        it, or None.
+        """
+        Async = Pool().get('async.async')
+
+        while datetime.utcnow() < end_time:
+            queue = Async.get_queue(self.result_uuid)
+            if queue:
+                return queue
+            else:
+                time.sleep(interval_seconds)
+
+    @staticmethod
+    def get_end_time(wait_time_seconds):
+        if wait_time_seconds:
+            return datetime.utcnow() + timedelta(seconds=wait_time_seconds)
+        return datetime.max
+
+    @staticmethod
+    def get_seconds_left(end_time):
+        if end_time == datetime.max:
+            return 20
+        return int((end_time - datetime.utcnow()).total_seconds())
+
 
 ResultOptions = namedtuple(
     'ResultOptions', [
         'ignore_result',
         'visibility_timeout',
+        'chunk_size',           # Items per message for generator tasks
+    ]
+)
+# Messages sent before the chunk size was added have two options
+ResultOptions.__new__.__defaults__ = (100, )
+
+#: Version of the compact envelope of the task messages
+ENVELOPE_VERSION = 2
+
+# Parameters of the values of the message attributes by key in boto
+ATTRIBUTE_KEYS = {
+    'data_type': 'DataType',
+    'string_value': 'StringValue',
+    'binary_value': 'BinaryValue',
+}
+
+# Keys of the compact envelope by key of the payload
+COMPACT_KEYS = {
+    'database_name': 'd',
+    'user': 'u',
+    'context': 'c',
+    'instance': 'i',
+    'args': 'a',
+    'kwargs': 'kw',
+    '__result_uuid__': 'r',
+    '__result_options__': 'o',
+}
+
+QueueStats = namedtuple(
+    'QueueStats', [
+        'name',
+        'depth',            # Messages waiting to be received
+        'in_flight',        # Messages received but not yet deleted
+        'delayed',          # Messages not yet visible due to a delay
+        'oldest_age',       # Seconds since the oldest sampled message
+        'timestamp',        # When the statistics were fetched
     ]
 )
 
@@ -143,6 +446,23 @@ class Async(ModelView):
 
     _result_class = AsyncResult
 
+    # Cache of QueueStats by (database, queue name)
+    _queue_stats = {}
+
+    # In-process cache of the results of tasks with a cache TTL
+    _memory_result_cache = None
+
+    # Registry of the tasks by database, built from its pool of models
+    _task_registries = {}
+
+    # Exporters of the spans of the tasks by path
+    _trace_exporters = {}
+
+    # Results of the tasks executed in the process in eager mode and the
+    # threads executing them
+    _eager_results = EagerResults()
+    _eager_executor = None
+
     @classmethod
     def get_sqs_connection(cls):
         """
@@ -152,19 +472,52 @@ class Async(ModelView):
 
         AWS_ACCESS_KEY_ID -  Your AWS Access Key ID
         AWS_SECRET_ACCESS_KEY - Your AWS Secret Access Key
+
+        The connection is made to the `sqs_region` if one is given.
+
+        boto is only imported here, so that the processes loading the
+        module but never using SQS do not pay for it.
         """
+        import boto.sqs
+
+        region = CONFIG.options.get('sqs_region')
+        if region:
+            return boto.sqs.connect_to_region(
+                region,
+                aws_access_key_id=CONFIG.options.get('sqs_access_key'),
+                aws_secret_access_key=CONFIG.options.get('sqs_secret_key'),
+            )
         return boto.connect_sqs(
             CONFIG.options.get('sqs_access_key'),
             CONFIG.options.get('sqs_secret_key'),
         )
 
+    @classmethod
+    def get_transport(cls):
+        """
+        Returns the connection to the message queues selected by the
+        `async_transport` option: `sqs` (default) or `sqlite`, a durable
+        queue in the local SQLite database at `async_queue_path`.
+
+        Override this to plug in another transport implementing the part
+        of the boto SQS API used by the module (see `transport.py`).
+        """
+        if CONFIG.options.get('async_transport') == 'sqlite':
+            return SQLiteTransport(
+                CONFIG.options.get('async_queue_path') or os.path.join(
+                    CONFIG.options['data_path'], 'async-queue.sqlite'
+                )
+            )
+        return cls.get_sqs_connection()
+
     @classmethod
     def execute_task(cls, payload):
         """
         Execute the task for the given payload
         """
-        result_options = ResultOptions._make(
-            payload.get('__result_options__', [True, 60])
+        payload = cls.expand_payload(payload)
+        result_options = ResultOptions(
+            *payload.get('__result_options__', [True, 60])
         )
 
         result = cls.execute(
@@ -175,10 +528,230 @@ class Async(ModelView):
             payload['kwargs'],
         )
 
-        if not result_options.ignore_result:
-            # Send the result as message
-            cls.reply_to_sqs(payload['__result_uuid__'], {'result': result})
+        if inspect.isgenerator(result):
+            if result_options.ignore_result:
+                for item in result:
+                    pass
+            else:
+                cls.stream_to_sqs(
+                    payload['__result_uuid__'], result,
+                    result_options.chunk_size,
+                )
+            # The items are not kept, not to hold them all in memory
+            result = None
+        else:
+            if not result_options.ignore_result:
+                # Send the result as message
+                cls.reply_to_sqs(
+                    payload['__result_uuid__'], {'result': result}
+                )
+            # The memory of the worker is read by no client, the result is
+            # cached by the client reading it (see AsyncResult.cache_result)
+            if cls.get_result_cache().shared:
+                cls.cache_task_result(payload, result)
+
+        cls.execute_callbacks(payload, result)
+
+        return result
+
+    @classmethod
+    def cache_task_result(cls, payload, result):
+        """
+        Cache the result of the task if it has a cache TTL
+        """
+        if payload.get('__cache__'):
+            key, ttl = payload['__cache__']
+            cls.get_result_cache().set(
+                key, cls.serialize_payload(result), ttl
+            )
+
+    @classmethod
+    def get_tasks(cls):
+        """
+        Returns the tasks of the database, the methods decorated with
+        :class:`async_task`, as a dictionary of `model.method` to their
+        decorator.
+
+        The registry is built from the pool the first time it is needed
+        and again only if the pool is reloaded.
+        """
+        pool = Pool()
+        models = pool._pool[pool.database_name]['model']
+        registry = cls._task_registries.get(pool.database_name)
+        if registry is None or registry[0] is not models:
+            registry = cls._task_registries[pool.database_name] = (
+                models, cls.find_tasks(models.values())
+            )
+        return registry[1]
+
+    @staticmethod
+    def find_tasks(models):
+        """
+        Returns the methods of the models decorated with :class:`async_task`
+        as a dictionary of `model.method` to their decorator.
+        """
+        tasks = {}
+        for model in models:
+            for name in async_task.method_names:
+                for klass in model.__mro__:
+                    # The attribute as Python resolves it, without binding
+                    if name not in vars(klass):
+                        continue
+                    value = vars(klass)[name]
+                    if isinstance(value, TaskFunctionWrapper):
+                        tasks['%s.%s' % (model.__name__, name)] = \
+                            value._self_task
+                    break
+        return tasks
+
+    @classmethod
+    def check_task(cls, model_name, method_name):
+        """
+        Returns the :class:`async_task` decorator of the task, or None if
+        the method is not decorated.
+
+        Raises :class:`UnknownTask` if the model or the method does not
+        exist, or if the method is not decorated and the
+        `async_registered_only` option is set.
+        """
+        task = cls.get_tasks().get('%s.%s' % (model_name, method_name))
+        if task is not None:
+            return task
+        if CONFIG.options.get('async_registered_only'):
+            raise UnknownTask(
+                '%s.%s is not an async task' % (model_name, method_name)
+            )
+        try:
+            Model = Pool().get(model_name)
+        except KeyError:
+            raise UnknownTask('Unknown model %s' % model_name)
+        if not hasattr(Model, method_name):
+            raise UnknownTask(
+                'Unknown method %s.%s' % (model_name, method_name)
+            )
+
+    @classmethod
+    def get_trace_exporter(cls):
+        """
+        Returns the exporter of the spans of the tasks selected by the
+        `async_trace` option: `file` appends them to `async_trace_file`.
+        None disables tracing.
+
+        Override this to plug in another exporter, an object with an
+        `export(span)` method.
+        """
+        if CONFIG.options.get('async_trace') != 'file':
+            return None
+        path = CONFIG.options.get('async_trace_file') or os.path.join(
+            CONFIG.options['data_path'], 'async-trace.jsonl'
+        )
+        if path not in cls._trace_exporters:
+            cls._trace_exporters[path] = FileExporter(path)
+        return cls._trace_exporters[path]
+
+    @classmethod
+    def trace(cls, name, trace_id=None, parent_id=None, start=None,
+              **attributes):
+        """
+        Returns a :class:`~tracing.Span` to time an operation, child of
+        the current span of the thread unless a trace and parent are
+        given. Returns a :class:`~tracing.NullSpan` if tracing is disabled.
+        """
+        exporter = cls.get_trace_exporter()
+        if exporter is None:
+            return NullSpan()
+        return Span(exporter, name, trace_id, parent_id, start, **attributes)
+
+    @classmethod
+    def get_eager_mode(cls):
+        """
+        Returns how deferred tasks are executed in the process, set by the
+        `async_eager` option: `immediate`, `thread` or None to send them
+        to the queues.
+        """
+        return CONFIG.options.get('async_eager') or None
 
+    @classmethod
+    def get_eager_executor(cls):
+        """
+        Returns the threads executing the tasks in `thread` eager mode
+        """
+        if cls._eager_executor is None:
+            cls._eager_executor = EagerExecutor(
+                int(CONFIG.options.get('async_eager_threads', 4))
+            )
+        return cls._eager_executor
+
+    @classmethod
+    def execute_eager(cls, payload, result_options=None):
+        """
+        Execute the task in the process instead of sending it to a queue.
+
+        The payload is serialized and deserialized as if it went through
+        a queue. In `immediate` mode the task is executed right away in
+        the current transaction, so its errors are raised to the caller.
+        In `thread` mode it is executed by a local thread in its own
+        transaction.
+        """
+        message = cls.serialize_task(payload, result_options)
+
+        if cls.get_eager_mode() == 'thread':
+            cls.get_eager_executor().submit(
+                cls.execute_eager_message, payload['database_name'],
+                payload['user'], dict(payload['context']), message,
+            )
+        else:
+            cls.execute_eager_task(cls.deserialize_task(message))
+        return cls._result_class(payload)
+
+    @classmethod
+    def execute_eager_message(cls, database_name, user, context, message):
+        """
+        Execute the task of the message in a new transaction, as a worker
+        would. The exception of a failed task is kept in place of its
+        result.
+        """
+        with Transaction().start(
+                database_name, user, context=context) as transaction:
+            payload = cls.deserialize_task(message)
+            try:
+                cls.execute_eager_task(payload)
+            except Exception, exc:
+                logger.exception('Transaction Rollback due to failure')
+                transaction.cursor.rollback()
+                result_options = ResultOptions(
+                    *payload['__result_options__']
+                )
+                if not result_options.ignore_result:
+                    # Raised to the caller waiting for the result
+                    cls._eager_results.set(
+                        payload['__result_uuid__'], None, exc
+                    )
+            else:
+                transaction.cursor.commit()
+
+    @classmethod
+    def execute_eager_task(cls, payload):
+        """
+        Execute the task of the payload and keep its result in the process
+        for :meth:`AsyncResult.wait`
+        """
+        result_options = ResultOptions(*payload['__result_options__'])
+
+        result = cls.execute(
+            payload['model_name'],
+            payload['method_name'],
+            payload['instance'],
+            payload['args'],
+            payload['kwargs'],
+        )
+        if inspect.isgenerator(result):
+            result = list(result)
+
+        if not result_options.ignore_result:
+            cls._eager_results.set(payload['__result_uuid__'], result)
+        cls.cache_task_result(payload, result)
+        cls.execute_callbacks(payload, result)
         return result
 
     @classmethod
@@ -193,7 +766,9 @@ class Async(ModelView):
     @classmethod
     def defer(cls, method, model=None, instance=None,
               args=None, kwargs=None,
-              delay_seconds=0, attributes=None, result_options=None):
+              delay_seconds=0, attributes=None, result_options=None,
+              queue=None, eta=None, cache_ttl=None, time_limit=None,
+              soft_time_limit=None):
         """Wrapper for painless asynchronous dispatch of method
         inside given model.
 
@@ -212,8 +787,46 @@ class Async(ModelView):
                          if it is an instance
         :param args: positional arguments passed on to method as list/tuple.
         :param kwargs: keyword arguments passed on to method as dict.
+        :param queue: Name of the queue to send the task to. Routing rules
+                      in the configuration take precedence over this (see
+                      :meth:`get_route`).
+        :param delay_seconds: Number of seconds to delay the task. Tasks
+                              delayed for more than 900 seconds are
+                              scheduled (see :meth:`send_to_sqs`).
+        :param eta: UTC datetime at which the task should run. Overrides
+                    `delay_seconds`.
+        :param cache_ttl: Seconds to cache the result of the task for. Only
+                          for tasks whose result depends solely on their
+                          arguments and context (see :meth:`defer_signature`)
+        :param time_limit: Seconds after which the worker abandons the task
+        :param soft_time_limit: Seconds after which
+                                :class:`SoftTimeLimitExceeded` is raised in
+                                the task
         :returns :class:`AsyncResult`:
         """
+        if eta is not None:
+            delay_seconds = max(
+                0, int(math.ceil(
+                    (eta - datetime.utcnow()).total_seconds()
+                ))
+            )
+
+        return cls.defer_signature(
+            cls.signature(method, model, instance, args, kwargs, queue),
+            delay_seconds, attributes, result_options, cache_ttl,
+            time_limit, soft_time_limit,
+        )
+
+    @classmethod
+    def signature(cls, method, model=None, instance=None,
+                  args=None, kwargs=None, queue=None):
+        """
+        Returns the description of a call to a task, to be deferred with
+        :meth:`defer_signature` or composed with :meth:`chain`,
+        :meth:`group` and :meth:`chord`.
+
+        The arguments are the same as for :meth:`defer`.
+        """
         if isinstance(method, basestring):
             method_name = method
         else:
@@ -229,23 +842,385 @@ class Async(ModelView):
         if isinstance(instance, Model):
             model_name = instance.__name__
 
-        payload = {
-            'database_name': Transaction().cursor.database_name,
-            'user': Transaction().user,
+        return {
             'model_name': model_name,
             'instance': instance,
             'method_name': method_name,
-            'args': args or [],
+            'args': list(args or []),
             'kwargs': kwargs or {},
-            'context': Transaction().context,
+            'queue': queue,
         }
+
+    @classmethod
+    def defer_signature(cls, signature, delay_seconds=0, attributes=None,
+                        result_options=None, cache_ttl=None,
+                        time_limit=None, soft_time_limit=None):
+        """
+        Send the task described by the signature (see :meth:`signature`) to
+        its queue.
+
+        If a `cache_ttl` is given and the result of the same call (same
+        database, model, method, arguments and context) is cached, nothing
+        is sent and a completed result is returned. Otherwise the result is
+        cached for `cache_ttl` seconds, by the worker in a shared cache or
+        by the client reading it in the memory cache of its process.
+
+        The time limits are enforced by the worker executing the task.
+
+        The options not given are those of the :class:`async_task`
+        decorator of the method, if it is decorated. Raises
+        :class:`UnknownTask` if the task does not exist.
+
+        In eager mode (see :meth:`execute_eager`) the task is executed in
+        the process, without delay.
+
+        :returns :class:`AsyncResult`:
+        """
+        payload = {
+            'database_name': Transaction().cursor.database_name,
+            'user': Transaction().user,
+            'context': cls.get_task_context(),
+        }
+        payload.update(signature)
+        queue_name = payload.pop('queue', None)
+
+        task = cls.check_task(payload['model_name'], payload['method_name'])
+        if task is not None:
+            queue_name = queue_name or task.queue
+            result_options = result_options or task.result_options
+            cache_ttl = cache_ttl or task.cache_ttl
+            time_limit = time_limit or task.time_limit
+            soft_time_limit = soft_time_limit or task.soft_time_limit
+
+        queue_name = cls.get_route(
+            payload['model_name'], payload['method_name'], queue_name
+        )
+
+        if cache_ttl:
+            key = cls.get_cache_key(payload)
+            found, result = cls.get_result_cache().get(key)
+            if found:
+                return cls.get_cached_result(result)
+            payload['__cache__'] = [key, cache_ttl]
+
+        if time_limit or soft_time_limit:
+            payload['__time_limits__'] = [soft_time_limit, time_limit]
+
+        if cls.get_eager_mode():
+            return cls.execute_eager(payload, result_options)
+
+        queue = cls.get_queue(queue_name, create=True)
+        delay_seconds = cls.throttle(queue, queue_name, task, delay_seconds)
         return cls.send_to_sqs(
-            cls.get_queue(create=True), payload,
-            delay_seconds, attributes, result_options
+            queue, payload, delay_seconds, attributes, result_options,
+            *cls.get_message_ids(queue, payload, task)
+        )
+
+    @classmethod
+    def throttle(cls, queue, queue_name, task, delay_seconds=0):
+        """
+        Returns the delay of the task once held back by the backpressure on
+        its queue if it is a low priority task, and by its rate limit (see
+        :class:`async_task`).
+
+        The rate limit delays the tasks deferred beyond the rate so that
+        they are executed at the rate, and FIFO queues, which cannot delay
+        messages, make the caller wait instead.
+        """
+        if task is None:
+            return delay_seconds
+        fifo = queue.name.endswith('.fifo')
+        if task.low_priority:
+            delay_seconds = cls.apply_backpressure(
+                queue_name, delay_seconds, fifo
+            )
+        if task.bucket:
+            wait = task.bucket.reserve()
+            if fifo:
+                time.sleep(wait)
+            else:
+                delay_seconds += int(math.ceil(wait))
+        return delay_seconds
+
+    @classmethod
+    def apply_backpressure(cls, queue_name, delay_seconds=0, fifo=False):
+        """
+        Returns the delay of a low priority task to the queue, once the
+        backlog of the queue (waiting, in flight and delayed messages) is
+        under the `async_high_watermark` option.
+
+        Past the watermark, the `async_backpressure` option decides:
+
+        * `block` waits until the backlog falls under
+          `async_low_watermark` (half the high one by default), for at most
+          `async_backpressure_timeout` seconds (Default: 60).
+        * `delay` delays the task by `async_backpressure_delay` seconds
+          (Default: 300). A `fifo` queue cannot delay messages, so the task
+          is blocked instead.
+        * `shed` drops the task.
+
+        The backlog is read from the cached :meth:`get_queue_stats`, so
+        this costs a request to SQS every few seconds at most. Raises
+        :class:`QueueFull` when the task is shed or blocked too long.
+        """
+        mode = CONFIG.options.get('async_backpressure')
+        high_watermark = int(CONFIG.options.get('async_high_watermark', 0))
+        if not mode or not high_watermark \
+                or cls.get_backlog(queue_name) < high_watermark:
+            return delay_seconds
+
+        if mode == 'delay' and not fifo:
+            return max(delay_seconds, int(
+                CONFIG.options.get('async_backpressure_delay', 300)
+            ))
+        if mode in ('block', 'delay'):
+            low_watermark = int(CONFIG.options.get(
+                'async_low_watermark', high_watermark // 2
+            ))
+            end_time = time.time() + float(
+                CONFIG.options.get('async_backpressure_timeout', 60)
+            )
+            while time.time() < end_time:
+                time.sleep(1)
+                if cls.get_backlog(queue_name) < low_watermark:
+                    return delay_seconds
+        raise QueueFull(
+            'Queue %s is past its high watermark of %d messages' % (
+                queue_name or 'default', high_watermark
+            )
+        )
+
+    @classmethod
+    def get_backlog(cls, queue_name):
+        """
+        Returns the number of messages waiting, in flight or delayed in the
+        queue, from the cached statistics
+        """
+        stats = cls.get_queue_stats(queue_name)
+        if stats is None:
+            return 0
+        return stats.depth + stats.in_flight + stats.delayed
+
+    @classmethod
+    def get_message_ids(cls, queue, payload, task=None):
+        """
+        Returns the message group and deduplication IDs of the task if the
+        queue is a FIFO queue, or Nones.
+
+        The tasks of a group are executed one after the other in the order
+        they were sent. By default the group is the record of the task, or
+        the model if it is not called on a single record, so that the tasks
+        updating a record never overtake each other. The `message_group`
+        of the :class:`async_task` decorator, a function of the payload,
+        overrides it.
+
+        The deduplication ID is unique to the message unless the task is
+        decorated with `deduplicate=True`: then the same call sent again
+        within 5 minutes is dropped by SQS.
+        """
+        if not queue.name.endswith('.fifo'):
+            return None, None
+        if task is not None and task.message_group is not None:
+            group_id = task.message_group(payload)
+        else:
+            group_id = cls.get_record_group(payload)
+        if task is not None and task.deduplicate:
+            return group_id, cls.get_cache_key(payload)
+        return group_id, None
+
+    @staticmethod
+    def get_record_group(payload):
+        """
+        Returns `model,id` of the record the task is called on, as instance
+        or as the only record of its first argument, otherwise the model
+        """
+        record = payload['instance']
+        args = payload['args']
+        if record is None and args and isinstance(args[0], (list, tuple)) \
+                and len(args[0]) == 1 and isinstance(args[0][0], Model):
+            record, = args[0]
+        if record is None:
+            return payload['model_name']
+        return '%s,%s' % (record.__name__, record.id)
+
+    @classmethod
+    def get_result_cache(cls):
+        """
+        Returns the cache of results selected by the `async_result_cache`
+        option: `memory` (default) or `table`.
+        """
+        if CONFIG.options.get('async_result_cache') == 'table':
+            return Pool().get('async.result_cache')
+        if cls._memory_result_cache is None:
+            cls._memory_result_cache = MemoryResultCache(
+                int(CONFIG.options.get('async_result_cache_size', 1000))
+            )
+        return cls._memory_result_cache
+
+    @classmethod
+    def get_cache_key(cls, payload):
+        """
+        Returns a stable hash of the call described by the payload
+        """
+        call = [
+            payload[key] for key in (
+                'database_name', 'user', 'model_name', 'method_name',
+                'instance', 'args', 'kwargs', 'context',
+            )
+        ]
+        return hashlib.sha1(
+            json.dumps(call, cls=cls.get_json_encoder(), sort_keys=True)
+        ).hexdigest()
+
+    @classmethod
+    def get_cached_result(cls, result):
+        """
+        Returns a completed :class:`AsyncResult` for the serialized result
+        """
+        async_result = cls._result_class({
+            '__result_uuid__': None,
+            '__result_options__': ResultOptions(False, 60),
+        })
+        async_result.result = cls.deserialize_message(result)
+        async_result.done = True
+        return async_result
+
+    @classmethod
+    def chain(cls, signatures, result_options=None):
+        """
+        Run the tasks one after the other, the result of each task being
+        passed as the first argument to the next one.
+
+        The next task is sent by the worker executing the previous one, so
+        no client has to wait for the intermediate results.
+
+        :param signatures: List of task signatures (see :meth:`signature`)
+        :param result_options: Result options of the last task
+        :returns :class:`AsyncResult`: The result of the last task
+        """
+        signatures = list(signatures)
+        signatures[-1], result = cls._with_result(
+            signatures[-1], result_options
+        )
+        first = dict(signatures[0], __chain__=signatures[1:])
+        cls.defer_signature(first, result_options=first.get(
+            '__result_options__'
+        ))
+        return result
+
+    @classmethod
+    def group(cls, signatures, result_options=None):
+        """
+        Run the tasks in parallel.
+
+        :returns: A list of :class:`AsyncResult`, one per task
+        """
+        return [
+            cls.defer_signature(signature, result_options=result_options)
+            for signature in signatures
+        ]
+
+    @classmethod
+    def chord(cls, signatures, callback, result_options=None):
+        """
+        Run the tasks in parallel and then the callback, with the list of
+        their results passed as its first argument.
+
+        The workers count the tasks which are done (see `async.chord`) and
+        the one executing the last task sends the callback, so no client
+        has to wait for the results of the tasks. The callback is never
+        sent if one of the tasks fails.
+
+        :param signatures: List of task signatures (see :meth:`signature`)
+        :param callback: Signature of the callback
+        :param result_options: Result options of the callback
+        :returns :class:`AsyncResult`: The result of the callback
+        """
+        Chord = Pool().get('async.chord')
+
+        callback, result = cls._with_result(callback, result_options)
+        chord_id = Chord.start(len(signatures), callback)
+        for index, signature in enumerate(signatures):
+            cls.defer_signature(
+                dict(signature, __chord__=chord_id, __chord_index__=index)
+            )
+        return result
+
+    @classmethod
+    def _with_result(cls, signature, result_options=None):
+        """
+        Returns the signature with its result UUID fixed in advance and the
+        :class:`AsyncResult` for it.
+        """
+        if result_options is None:
+            result_options = ResultOptions(
+                ignore_result=True,
+                visibility_timeout=60,
+            )
+        signature = dict(
+            signature,
+            __result_uuid__=str(uuid4()),
+            __result_options__=tuple(result_options),
+        )
+        return signature, cls._result_class(signature)
+
+    @classmethod
+    def execute_callbacks(cls, payload, result):
+        """
+        Send the tasks which depend on the task of the payload, now that it
+        succeeded with the given result.
+        """
+        chain = payload.get('__chain__')
+        if chain:
+            signature = dict(chain[0], __chain__=chain[1:])
+            signature['args'] = [result] + list(signature['args'])
+            cls.defer_signature(
+                signature,
+                result_options=signature.get('__result_options__'),
+            )
+
+        if payload.get('__chord__') is not None:
+            Chord = Pool().get('async.chord')
+            Chord.add_result(
+                payload['__chord__'], payload['__chord_index__'], result
+            )
+
+    @classmethod
+    def get_routes(cls):
+        """
+        Returns the routing rules set in the `sqs_routes` configuration
+        option as a dictionary of `model` or `model.method` to queue name.
+
+        The option is a comma separated list of `target=queue` pairs::
+
+            sqs_routes = report.bigreport=reports, electronic_mail=email
+        """
+        routes = {}
+        for rule in CONFIG.options.get('sqs_routes', '').split(','):
+            if not rule.strip():
+                continue
+            target, queue_name = rule.split('=', 1)
+            routes[target.strip()] = queue_name.strip()
+        return routes
+
+    @classmethod
+    def get_route(cls, model_name, method_name, default=None):
+        """
+        Returns the name of the queue to which a task on the given model and
+        method should be sent.
+
+        A rule for the `model.method` wins over a rule for the model, and
+        both win over the given default (usually the queue set on the
+        `async_task` decorator). None means the default queue.
+        """
+        routes = cls.get_routes()
+        return routes.get(
+            '%s.%s' % (model_name, method_name),
+            routes.get(model_name, default)
         )
 
     @classmethod
-    def get_queue(cls, name='trytond-async', create=False):
+    def get_queue(cls, name=None, create=False, database_name=None):
         """
         Retrieves the queue with the given name or None.
 
@@ -253,15 +1228,23 @@ class Async(ModelView):
         changed by setting the `sqs_queue` option in configuration.
 
         To specify the owner uses `sqs_queue_owner`
+
+        The queue is the one of the database of the transaction, unless a
+        `database_name` is given, which needs no transaction.
         """
-        connection = cls.get_sqs_connection()
+        connection = cls.get_transport()
+
+        if name is None:
+            name = CONFIG.options.get('sqs_queue', 'trytond-async')
+        if database_name is None:
+            database_name = Transaction().cursor.dbname
 
         queue_name = '-'.join(
             filter(
                 None, [
                     CONFIG.options.get('sqs_queue_prefix', None),
-                    Transaction().cursor.dbname.replace(':', ''),
-                    CONFIG.options.get('sqs_queue', name),
+                    database_name.replace(':', ''),
+                    name,
                 ]
             )
         )
@@ -270,40 +1253,353 @@ class Async(ModelView):
             CONFIG.options.get('sqs_queue_owner')
         )
         if queue is None and create:
-            queue = connection.create_queue(queue_name)
+            queue = cls.create_queue(connection, queue_name)
 
         return queue
 
+    @classmethod
+    def create_queue(cls, connection, queue_name):
+        """
+        Create the queue, a FIFO queue if its name ends with `.fifo` as SQS
+        requires.
+        """
+        if not queue_name.endswith('.fifo'):
+            return connection.create_queue(queue_name)
+
+        from boto.sqs.connection import SQSConnection
+        from boto.sqs.queue import Queue
+
+        if not isinstance(connection, SQSConnection):
+            return connection.create_queue(queue_name)
+        # boto 2 predates FIFO queues, the request is made by hand
+        return connection.get_object('CreateQueue', {
+            'QueueName': queue_name,
+            'Attribute.1.Name': 'FifoQueue',
+            'Attribute.1.Value': 'true',
+        }, Queue)
+
+    @classmethod
+    def get_queue_stats(cls, name=None, max_age=None, sample_age=False):
+        """
+        Returns the :class:`QueueStats` of the queue with the given name or
+        None if there is no such queue.
+
+        The statistics are cached for `max_age` seconds, which defaults to
+        the `sqs_stats_cache` option or 5 seconds, so this is cheap enough
+        to be called every few seconds by an autoscaler.
+
+        The age of the oldest message is left at 0 unless `sample_age` is
+        set. It is then estimated from the `SentTimestamp` of up to 10
+        messages received without hiding them. SQS returns a sample of the
+        messages, so this is a lower bound. Sampling counts as a receive of
+        those messages, which brings them closer to the `maxReceiveCount`
+        of a redrive policy, so it is only meant for occasional checks.
+        """
+        if max_age is None:
+            max_age = float(CONFIG.options.get('sqs_stats_cache', 5))
+        key = (Transaction().cursor.database_name, name, sample_age)
+
+        stats = cls._queue_stats.get(key)
+        if stats is not None and time.time() - stats.timestamp < max_age:
+            return stats
+
+        queue = cls.get_queue(name)
+        if queue is None:
+            return None
+
+        attributes = queue.get_attributes('All')
+        depth = int(attributes.get('ApproximateNumberOfMessages', 0))
+        oldest_age = 0
+        if depth and sample_age:
+            messages = cls.get_transport().receive_message(
+                queue, number_messages=10, visibility_timeout=0,
+                attributes='SentTimestamp',
+            )
+            if messages:
+                sent_at = min(
+                    float(message.attributes['SentTimestamp'])
+                    for message in messages
+                )
+                oldest_age = max(0, time.time() - sent_at / 1000.0)
+
+        stats = cls._queue_stats[key] = QueueStats(
+            name=queue.name,
+            depth=depth,
+            in_flight=int(
+                attributes.get('ApproximateNumberOfMessagesNotVisible', 0)
+            ),
+            delayed=int(
+                attributes.get('ApproximateNumberOfMessagesDelayed', 0)
+            ),
+            oldest_age=oldest_age,
+            timestamp=time.time(),
+        )
+        return stats
+
+    @classmethod
+    def get_task_seconds(cls, previous, stats):
+        """
+        Estimate the seconds a message of the queue stays in flight from
+        two :class:`QueueStats` taken a while apart, or None when the
+        backlog did not drain meanwhile.
+
+        By Little's law, the messages in flight are the rate at which they
+        are executed times the time each one stays in flight. The backlog
+        drain is taken as the rate, which ignores the messages sent
+        meanwhile, so the estimate errs on the slow side.
+        """
+        elapsed = stats.timestamp - previous.timestamp
+        drained = (previous.depth + previous.in_flight) - \
+            (stats.depth + stats.in_flight)
+        if elapsed <= 0 or drained <= 0:
+            return None
+        in_flight = (previous.in_flight + stats.in_flight) / 2.0
+        return in_flight * elapsed / drained or None
+
+    @classmethod
+    def get_workers_needed(cls, stats, task_seconds, target_age=60,
+                           concurrency=1):
+        """
+        Estimate the number of workers needed to execute the messages of
+        the queue within `target_age` seconds.
+
+        :param stats: The :class:`QueueStats` of the queue
+        :param task_seconds: Average execution time of a task, as estimated
+                             by :meth:`get_task_seconds`
+        :param target_age: Seconds in which the backlog should be executed
+        :param concurrency: Number of tasks each worker executes at a time
+        """
+        backlog = stats.depth + stats.in_flight
+        if not backlog:
+            return 0
+        tasks_per_worker = concurrency * target_age / float(task_seconds)
+        return int(math.ceil(backlog / tasks_per_worker))
+
     @classmethod
     def send_to_sqs(
             cls, queue, payload, delay_seconds=0,
-            attributes=None, result_options=None):
+            attributes=None, result_options=None, message_group_id=None,
+            deduplication_id=None):
         """
         Send the given payload to the queue.
 
+        SQS cannot delay a message for more than 900 seconds. Messages to be
+        delayed longer are stored as `async.scheduled_task` in the current
+        transaction, and sent by the scheduler of the worker when they are
+        due within 900 seconds.
+
         :param payload: The dictionary of the message to send
-        :param delay_seconds: Number of seconds (0 - 900) to delay this message
+        :param delay_seconds: Number of seconds to delay this message
                               from being processed.
         :param attributes: Message attributes to set.
+        :param message_group_id: Message group of the message, required by
+                                 FIFO queues which cannot delay messages
+                                 (see :meth:`get_message_ids`)
+        :param deduplication_id: Deduplication ID of the message on a FIFO
+                                 queue. Defaults to the result UUID.
+        """
+        message = cls.serialize_task(payload, result_options)
+
+        if message_group_id is not None and delay_seconds:
+            raise ValueError('FIFO queues cannot delay messages')
+
+        with cls.trace(
+                'enqueue', queue=queue.name, delay_seconds=delay_seconds,
+                task='%s.%s' % (payload['model_name'], payload['method_name'])
+                ) as span:
+            # The worker continues the trace from the message attributes
+            attributes = span.inject(attributes)
+            if message_group_id is not None:
+                cls.send_fifo_message(
+                    queue, message, attributes, message_group_id,
+                    deduplication_id or payload['__result_uuid__'],
+                )
+            elif delay_seconds > MAX_DELAY_SECONDS:
+                ScheduledTask = Pool().get('async.scheduled_task')
+                ScheduledTask.schedule(
+                    queue, message, delay_seconds, attributes
+                )
+            else:
+                cls.get_transport().send_message(
+                    queue,
+                    message,
+                    delay_seconds=delay_seconds,
+                    message_attributes=attributes,
+                )
+
+        return cls._result_class(payload)
+
+    @classmethod
+    def send_fifo_message(cls, queue, message, attributes, message_group_id,
+                          deduplication_id):
+        """
+        Send the message to the FIFO queue
         """
-        connection = cls.get_sqs_connection()
+        from boto.sqs.connection import SQSConnection
+        from boto.sqs.message import Message
+
+        connection = cls.get_transport()
+        if not isinstance(connection, SQSConnection):
+            return connection.send_message(
+                queue, message, message_attributes=attributes,
+                message_group_id=message_group_id,
+                message_deduplication_id=deduplication_id,
+            )
+        # boto 2 predates FIFO queues, the request is made by hand
+        params = {
+            'MessageBody': message,
+            'MessageGroupId': message_group_id,
+            'MessageDeduplicationId': deduplication_id,
+        }
+        for index, name in enumerate(sorted(attributes or {}), start=1):
+            prefix = 'MessageAttribute.%d.' % index
+            params[prefix + 'Name'] = name
+            for key, value in attributes[name].iteritems():
+                params[prefix + 'Value.' + ATTRIBUTE_KEYS[key]] = value
+        return connection.get_object(
+            'SendMessage', params, Message, queue.id, verb='POST'
+        )
 
+    @classmethod
+    def serialize_task(cls, payload, result_options=None):
+        """
+        Set the result UUID and options of the payload and return the
+        message to send.
+        """
         if result_options is None:
             result_options = ResultOptions(
                 ignore_result=True,
                 visibility_timeout=60,
             )
-        payload['__result_uuid__'] = str(uuid4())
+        # The UUID of the result may be fixed in advance (see chain)
+        payload.setdefault('__result_uuid__', str(uuid4()))
         payload['__result_options__'] = tuple(result_options)
+        if CONFIG.options.get('async_envelope') == 'compact':
+            return cls.serialize_payload(cls.compact_payload(payload))
+        return cls.serialize_payload(payload)
 
-        connection.send_message(
-            queue,
-            cls.serialize_payload(payload),
-            delay_seconds=delay_seconds,
-            message_attributes=attributes,
+    @classmethod
+    def deserialize_task(cls, message):
+        """
+        Returns the payload of a task message, in either envelope
+        """
+        return cls.expand_payload(cls.deserialize_message(message))
+
+    @classmethod
+    def compact_payload(cls, payload):
+        """
+        Returns the compact envelope of the payload: short keys, a short
+        code for the tasks listed in `async_task_codes` and no values which
+        are the default ones.
+        """
+        codes = dict(
+            (task, code) for code, task in cls.get_task_codes().iteritems()
         )
+        task = '%s.%s' % (payload['model_name'], payload['method_name'])
+        envelope = {'v': ENVELOPE_VERSION}
+        if task in codes:
+            envelope['k'] = codes[task]
+        else:
+            envelope['m'] = payload['model_name']
+            envelope['f'] = payload['method_name']
 
-        return cls._result_class(payload)
+        for key, value in payload.iteritems():
+            if key in ('model_name', 'method_name') \
+                    or cls.is_default(key, value, payload):
+                continue
+            envelope[COMPACT_KEYS.get(key, key)] = value
+        return envelope
+
+    @staticmethod
+    def is_default(key, value, payload):
+        """
+        Returns True if the value of the key of the payload is the default
+        one, which the compact envelope omits.
+        """
+        if key in ('context', 'args', 'kwargs'):
+            return not value
+        if key == 'instance':
+            return value is None
+        options = ResultOptions(*payload['__result_options__'])
+        if key == '__result_uuid__':
+            # Only used to send the result back
+            return options.ignore_result
+        if key == '__result_options__':
+            return options == ResultOptions(True, 60)
+        return False
+
+    @classmethod
+    def expand_payload(cls, envelope):
+        """
+        Returns the payload of a compact envelope. Payloads sent in full
+        are returned as is. Raises :class:`UnknownTask` for a short code
+        missing from the `async_task_codes` option.
+        """
+        if envelope.get('v') != ENVELOPE_VERSION:
+            return envelope
+
+        keys = dict((short, key) for key, short in COMPACT_KEYS.iteritems())
+        payload = {
+            'context': {},
+            'instance': None,
+            'args': [],
+            'kwargs': {},
+            '__result_uuid__': None,
+            '__result_options__': list(ResultOptions(True, 60)),
+        }
+        for key, value in envelope.iteritems():
+            if key not in ('v', 'k', 'm', 'f'):
+                payload[keys.get(key, key)] = value
+        if 'k' in envelope:
+            task = cls.get_task_codes().get(envelope['k'])
+            if task is None:
+                raise UnknownTask('Unknown task code %s' % envelope['k'])
+            payload['model_name'], payload['method_name'] = \
+                task.rsplit('.', 1)
+        else:
+            payload['model_name'] = envelope['m']
+            payload['method_name'] = envelope['f']
+        return payload
+
+    @classmethod
+    def get_task_codes(cls):
+        """
+        Returns the short codes of the tasks set in the `async_task_codes`
+        option as a dictionary of code to `model.method`.
+
+        The option is a comma separated list of `code=model.method` pairs
+        and must be the same for the clients and the workers::
+
+            async_task_codes = m=electronic_mail.send, r=report.bigreport.run
+        """
+        codes = {}
+        for rule in CONFIG.options.get('async_task_codes', '').split(','):
+            if not rule.strip():
+                continue
+            code, task = rule.split('=', 1)
+            codes[code.strip()] = task.strip()
+        return codes
+
+    @classmethod
+    def get_task_context(cls):
+        """
+        Returns the context sent with the tasks: the transaction context,
+        restricted to the keys listed in the `async_context_keys` option
+        if set, less the keys listed in `async_context_exclude`.
+        """
+        context = dict(Transaction().context)
+        keys = filter(None, [
+            key.strip() for key in
+            CONFIG.options.get('async_context_keys', '').split(',')
+        ])
+        if keys:
+            context = dict(
+                (key, value) for key, value in context.iteritems()
+                if key in keys
+            )
+        for key in CONFIG.options.get('async_context_exclude', '').split(','):
+            context.pop(key.strip(), None)
+        return context
 
     @classmethod
     def reply_to_sqs(cls, result_uuid, payload):
@@ -315,12 +1611,53 @@ class Async(ModelView):
                               from being processed.
         :param attributes: Message attributes to set.
         """
-        connection = cls.get_sqs_connection()
-        queue = cls.get_queue(result_uuid, create=True)
-        return connection.send_message(
-            queue,
-            cls.serialize_payload(payload),
-        )
+        with cls.trace('reply'):
+            connection = cls.get_transport()
+            queue = cls.get_queue(result_uuid, create=True)
+            return connection.send_message(
+                queue,
+                cls.serialize_payload(payload),
+            )
+
+    @classmethod
+    def stream_to_sqs(cls, result_uuid, iterator, chunk_size=100):
+        """
+        Send the items of the iterator to the result queue in chunks of
+        chunk_size items as they are produced, followed by an end marker.
+
+        The chunks are numbered so that the client can put them back in
+        order. If the iterator raises, an error marker is sent in place of
+        the end marker, so that the client does not take the items already
+        sent for the whole result, and the exception is raised again.
+        """
+        with cls.trace('stream'):
+            connection = cls.get_transport()
+            queue = cls.get_queue(result_uuid, create=True)
+
+            def send(message):
+                connection.send_message(queue, cls.serialize_payload(message))
+
+            seq = 0
+            chunk = []
+            try:
+                for item in iterator:
+                    chunk.append(item)
+                    if len(chunk) >= chunk_size:
+                        send({'seq': seq, 'chunk': chunk})
+                        seq += 1
+                        chunk = []
+            except Exception, exception:
+                send({
+                    'seq': seq,
+                    'error': '%s: %s' % (
+                        exception.__class__.__name__, exception
+                    ),
+                })
+                raise
+            if chunk:
+                send({'seq': seq, 'chunk': chunk})
+                seq += 1
+            send({'seq': seq, 'end': True})
 
     @classmethod
     def get_json_encoder(cls):
@@ -0,0 +1,70 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.benchmarks.bench_startup
+
+    Measure what loading the module adds to the boot of a trytond process.
+
+    Each run imports and registers the module in a fresh interpreter, after
+    importing the parts of trytond every server loads anyway, and reports
+    whether boto got imported on the way::
+
+        python benchmarks/bench_startup.py --repeat 20
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import sys
+import argparse
+import subprocess
+
+CODE = """
+import sys
+import time
+
+import trytond.config
+import trytond.pool
+import trytond.model
+import trytond.transaction
+
+start = time.time()
+import trytond.modules.async_sqs
+trytond.modules.async_sqs.register()
+print('%f %d' % (time.time() - start, 'boto' in sys.modules))
+"""
+
+
+def run_once():
+    """
+    Returns the seconds taken to load the module in a fresh interpreter
+    and whether boto was imported
+    """
+    output = subprocess.check_output([sys.executable, '-c', CODE])
+    seconds, boto_imported = output.split()[-2:]
+    return float(seconds), bool(int(boto_imported))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument(
+        '--repeat', dest='repeat', type=int, default=10,
+        help="Number of fresh interpreters to measure"
+    )
+    args = parser.parse_args()
+
+    timings = []
+    for index in xrange(args.repeat):
+        seconds, boto_imported = run_once()
+        timings.append(seconds)
+    timings.sort()
+    print(
+        'Module load over %d runs: min %.1f ms, median %.1f ms, '
+        'max %.1f ms' % (
+            len(timings), timings[0] * 1000,
+            timings[len(timings) // 2] * 1000, timings[-1] * 1000,
+        )
+    )
+    print('boto imported at load: %s' % ('yes' if boto_imported else 'no'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.cache
+
+    Caches of the results of deterministic tasks.
+
+    Two backends are available, selected by the `async_result_cache`
+    option: an LRU cache in the memory of each process (`memory`, the
+    default) or a table shared by all the workers and clients of the
+    database (`table`).
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+
+__all__ = ['MemoryResultCache', 'ResultCache']
+
+
+class MemoryResultCache(object):
+    """
+    An LRU cache of serialized results, each expiring after its TTL.
+
+    :param size: Maximum number of results kept
+    """
+    #: Results are held by other processes
+    shared = False
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a tuple of whether the key was found and the result
+        """
+        with self.lock:
+            try:
+                expires, result = self.results.pop(key)
+            except KeyError:
+                return False, None
+            if expires < time.time():
+                return False, None
+            # Mark it as the most recently used
+            self.results[key] = (expires, result)
+            return True, result
+
+    def set(self, key, result, ttl):
+        """
+        Store the result for ttl seconds
+        """
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = (time.time() + ttl, result)
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+
+class ResultCache(ModelSQL):
+    """
+    Cached result of an asynchronous task
+    """
+    __name__ = 'async.result_cache'
+
+    #: Results are held by other processes
+    shared = True
+
+    key = fields.Char('Key', required=True, select=True)
+    result = fields.Text('Result')
+    expires = fields.DateTime('Expires', required=True, select=True)
+
+    @classmethod
+    def get(cls, key):
+        """
+        Returns a tuple of whether the key was found and the result
+        """
+        caches = cls.search([
+            ('key', '=', key),
+            ('expires', '>', datetime.utcnow()),
+        ], limit=1)
+        if not caches:
+            return False, None
+        return True, caches[0].result
+
+    @classmethod
+    def set(cls, key, result, ttl):
+        """
+        Store the result for ttl seconds, replacing any previous result
+        for the key, and purge the expired results.
+
+        The result is committed in its own transaction so that it is
+        available even if the current transaction is read-only or rolled
+        back.
+        """
+        now = datetime.utcnow()
+        with Transaction().new_cursor():
+            cls.delete(cls.search([
+                'OR',
+                ('key', '=', key),
+                ('expires', '<=', now),
+            ]))
+            cls.create([{
+                'key': key,
+                'result': result,
+                'expires': now + timedelta(seconds=ttl),
+            }])
+            Transaction().cursor.commit()
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.eager
+
+    Execution of the tasks in the process deferring them, for tests and
+    small installs (`async_eager` option).
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import time
+import Queue
+import logging
+import threading
+from collections import OrderedDict
+
+__all__ = ['EagerResults', 'EagerExecutor']
+
+logger = logging.getLogger('AsyncSQS')
+
+
+class EagerResults(object):
+    """
+    Results of the tasks executed in the process, kept by result UUID
+    until they are fetched. The oldest results are dropped once more than
+    `size` were never fetched.
+
+    :param size: Maximum number of results kept
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.results = OrderedDict()
+        self.condition = threading.Condition()
+
+    def set(self, result_uuid, result, exception=None):
+        """
+        Store the result of the task, or the exception it failed with
+        """
+        with self.condition:
+            self.results[result_uuid] = (result, exception)
+            while len(self.results) > self.size:
+                dropped, _ = self.results.popitem(last=False)
+                logger.warning('Dropping eager result %s' % dropped)
+            self.condition.notify_all()
+
+    def pop(self, result_uuid, timeout=None):
+        """
+        Wait up to `timeout` seconds (forever if None) for the result.
+        Returns a tuple of whether it was found and the result, or raises
+        the exception of the task.
+        """
+        end_time = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while result_uuid not in self.results:
+                if end_time is None:
+                    # Wake up now and then, an endless wait is not
+                    # interrupted by signals
+                    self.condition.wait(1)
+                    continue
+                seconds_left = end_time - time.time()
+                if seconds_left <= 0:
+                    return False, None
+                self.condition.wait(seconds_left)
+            result, exception = self.results.pop(result_uuid)
+        if exception is not None:
+            raise exception
+        return True, result
+
+
+class EagerExecutor(object):
+    """
+    A pool of threads calling the functions submitted to it.
+
+    :param concurrency: Number of threads
+    """
+    def __init__(self, concurrency=4):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for index in xrange(concurrency):
+            thread = threading.Thread(
+                target=self.run, name='AsyncEager-%d' % index
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args):
+        self.tasks.put((function, args))
+
+    def join(self):
+        """
+        Wait until all the submitted functions returned
+        """
+        self.tasks.join()
+
+    def run(self):
+        while True:
+            function, args = self.tasks.get()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('Failed to execute eager task')
+            finally:
+                self.tasks.task_done()
@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.ratelimit
+
+    Rate limits of the tasks deferred by a process (`rate_limit` of the
+    `async_task` decorator).
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import time
+import threading
+
+__all__ = ['TokenBucket', 'parse_rate']
+
+#: Seconds per unit of the rates
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def parse_rate(rate):
+    """
+    Returns the tasks per second of a rate given as a number of tasks per
+    second or as a string like `10/s`, `100/m` or `1000/h`.
+    """
+    if not isinstance(rate, basestring):
+        return float(rate)
+    count, _, unit = rate.partition('/')
+    return float(count) / RATE_UNITS[unit.strip() or 's']
+
+
+class TokenBucket(object):
+    """
+    A bucket of `capacity` tokens refilled at `rate` tokens per second.
+
+    Instead of refusing the calls beyond the rate, the bucket tells how
+    long each one has to wait for its token. The tokens are handed out in
+    order, so calls made in a burst are spread at the rate.
+
+    :param rate: Tokens per second
+    :param capacity: Tokens available for a burst. Defaults to one second
+                     worth of tokens, at least one.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token and return the seconds to wait until it is due
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            # The tokens go negative as calls are promised future tokens
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
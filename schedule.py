@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.schedule
+
+    Tasks scheduled further out than the 15 minutes SQS can delay a message.
+
+    The serialized messages are kept in a table indexed on their ETA until
+    the scheduler of the worker moves them into their queue, with the
+    remaining delay, once they are due within 15 minutes.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import logging
+from datetime import datetime, timedelta
+
+from trytond.config import CONFIG
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+
+__all__ = ['ScheduledTask']
+
+logger = logging.getLogger('AsyncSQS')
+
+#: Longest delay SQS accepts for a message
+MAX_DELAY_SECONDS = 900
+
+
+class ScheduledTask(ModelSQL):
+    """
+    Asynchronous task scheduled for later
+    """
+    __name__ = 'async.scheduled_task'
+
+    eta = fields.DateTime('ETA', required=True, select=True)
+    queue = fields.Char('Queue', required=True)
+    message = fields.Text('Message', required=True)
+    attributes = fields.Text('Message Attributes')
+
+    @classmethod
+    def schedule(cls, queue, message, delay_seconds, attributes=None):
+        """
+        Schedule the serialized message to be sent to the queue in
+        `delay_seconds`.
+
+        The task is stored in the current transaction, so it is only
+        scheduled if the transaction is committed.
+        """
+        Async = Pool().get('async.async')
+
+        return cls.create([{
+            'eta': datetime.utcnow() + timedelta(seconds=delay_seconds),
+            'queue': queue.name,
+            'message': message,
+            'attributes': (
+                Async.serialize_payload(attributes) if attributes else None
+            ),
+        }])[0]
+
+    @classmethod
+    def send_due(cls, limit=100, horizon=MAX_DELAY_SECONDS - 60):
+        """
+        Send the tasks due within `horizon` seconds to their queue and
+        delete them. SQS delays each message for the time remaining until
+        its ETA.
+
+        Only the `limit` earliest tasks are sent, using the index on the
+        ETA. The tasks SQS fails to send are kept for the next call.
+        Returns the number of tasks sent.
+        """
+        Async = Pool().get('async.async')
+
+        now = datetime.utcnow()
+        tasks = cls.search([
+            ('eta', '<=', now + timedelta(seconds=horizon)),
+        ], order=[('eta', 'ASC'), ('id', 'ASC')], limit=limit)
+        if not tasks:
+            return 0
+
+        connection = Async.get_transport()
+        by_queue = {}
+        for task in tasks:
+            by_queue.setdefault(task.queue, []).append(task)
+
+        sent = []
+        for queue_name, queue_tasks in by_queue.iteritems():
+            queue = connection.get_queue(
+                queue_name, CONFIG.options.get('sqs_queue_owner')
+            )
+            if queue is None:
+                queue = connection.create_queue(queue_name)
+            # SQS accepts at most 10 messages per batch
+            for index in xrange(0, len(queue_tasks), 10):
+                batch = queue_tasks[index:index + 10]
+                results = connection.send_message_batch(queue, [
+                    (
+                        str(task.id), task.message, cls.get_delay(task, now),
+                        Async.deserialize_message(task.attributes)
+                        if task.attributes else {},
+                    )
+                    for task in batch
+                ])
+                failed = set(
+                    int(error['id'])
+                    for error in getattr(results, 'errors', [])
+                )
+                for task in batch:
+                    if task.id in failed:
+                        logger.error(
+                            'Failed to send scheduled task %d' % task.id
+                        )
+                    else:
+                        sent.append(task)
+
+        cls.delete(sent)
+        return len(sent)
+
+    @staticmethod
+    def get_delay(task, now):
+        """
+        Returns the seconds SQS should delay the message of the task
+        """
+        delay = (task.eta - now).total_seconds()
+        return int(min(MAX_DELAY_SECONDS, max(0, delay)))
@@ -12,6 +12,8 @@ import trytond.tests.test_tryton
 # from tests.test_views_depends import TestViewsDepends
 from tests.test_serialization import TestSerialization
 from tests.test_async import TestAsync
+from tests.test_worker import TestWorker
+from tests.test_transport import TestTransport
 
 
 def suite():
@@ -23,6 +25,8 @@ def suite():
         # unittest.TestLoader().loadTestsFromTestCase(TestViewsDepends),
         unittest.TestLoader().loadTestsFromTestCase(TestSerialization),
         unittest.TestLoader().loadTestsFromTestCase(TestAsync),
+        unittest.TestLoader().loadTestsFromTestCase(TestWorker),
+        unittest.TestLoader().loadTestsFromTestCase(TestTransport),
     ])
     return test_suite
 
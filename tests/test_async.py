@@ -16,7 +16,11 @@ DIR = os.path.abspath(os.path.normpath(os.path.join(
 )))
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
+import json
+import shutil
+import tempfile
 import unittest
+from datetime import datetime, timedelta
 
 
 # Mock SQS out
@@ -24,9 +28,17 @@ import boto
 from moto import mock_sqs
 
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT, POOL
 from trytond.transaction import Transaction
-from trytond.modules.async_sqs import ResultOptions
+from trytond.pool import PoolMeta
+from trytond.config import CONFIG
+from trytond.modules.async_sqs import ResultOptions, QueueStats, \
+    async_task, UnknownTask, IncompleteResult, QueueFull
+from trytond.modules.async_sqs.cache import MemoryResultCache
+from trytond.modules.async_sqs.eager import EagerResults
+from trytond.modules.async_sqs.ratelimit import TokenBucket, parse_rate
+from trytond.modules.async_sqs.tracing import Span
 
 os.environ['AWS_ACCESS_KEY_ID'] = "sqs-access-key"
 os.environ['AWS_SECRET_ACCESS_KEY'] = "sqs-secret-key"
@@ -64,6 +76,20 @@ class TestAsync(unittest.TestCase):
                 isinstance(connection, boto.sqs.connection.SQSConnection)
             )
 
+    def test_get_connection_region(self):
+        '''
+        The connection is made to the region of the configuration
+        '''
+        Async = POOL.get('async.async')
+
+        CONFIG.options['sqs_region'] = 'eu-west-1'
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                connection = Async.get_sqs_connection()
+                self.assertEqual(connection.region.name, 'eu-west-1')
+        finally:
+            del CONFIG.options['sqs_region']
+
     def test_execute_task(self):
         """
         Given a payload a task should get executed
@@ -239,6 +265,829 @@ class TestAsync(unittest.TestCase):
             # Now ensure that the result is same
             self.assertEqual(expected_result, result_async.wait())
 
+    def test_get_route(self):
+        """
+        Routing rules in the configuration map models and methods to queues
+        """
+        Async = POOL.get('async.async')
+
+        CONFIG.options['sqs_routes'] = (
+            'ir.ui.view=views, ir.ui.view.read=reads'
+        )
+        try:
+            self.assertEqual(Async.get_route('ir.ui.view', 'read'), 'reads')
+            self.assertEqual(
+                Async.get_route('ir.ui.view', 'search', 'other'), 'views'
+            )
+            self.assertEqual(
+                Async.get_route('res.user', 'read', 'other'), 'other'
+            )
+            self.assertEqual(Async.get_route('res.user', 'read'), None)
+        finally:
+            del CONFIG.options['sqs_routes']
+
+    @mock_sqs
+    def test_defer_queue(self):
+        """
+        Test that tasks are sent to the queue they are routed to
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            conn = Async.get_sqs_connection()
+
+            ids = map(int, IRUIView.search([], limit=10))
+            Async.defer(
+                model=IRUIView,
+                method=IRUIView.read,
+                args=[ids, ['name']],
+                queue='reports',
+            )
+
+            queue = Async.get_queue('reports')
+            messages = conn.receive_message(queue, number_messages=2)
+            self.assertEqual(len(messages), 1)
+
+            default_queue = Async.get_queue(create=True)
+            self.assertEqual(
+                len(conn.receive_message(default_queue, number_messages=2)),
+                0
+            )
+
+    @mock_sqs
+    def test_queue_stats(self):
+        """
+        Test the statistics of the queue and that they are cached
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(Async.get_queue_stats('stats', max_age=0), None)
+
+            ids = map(int, IRUIView.search([], limit=10))
+            for _ in range(3):
+                Async.defer(
+                    model=IRUIView,
+                    method=IRUIView.read,
+                    args=[ids, ['name']],
+                    queue='stats',
+                )
+
+            stats = Async.get_queue_stats('stats', max_age=0)
+            self.assertEqual(stats.depth, 3)
+            self.assertEqual(stats.in_flight, 0)
+            self.assertEqual(stats.oldest_age, 0)
+
+            sampled = Async.get_queue_stats(
+                'stats', max_age=0, sample_age=True
+            )
+            self.assertTrue(sampled.oldest_age >= 0)
+
+            # Cached statistics are returned as long as they are fresh
+            self.assertTrue(Async.get_queue_stats('stats', 60) is stats)
+
+    @mock_sqs
+    def test_backpressure(self):
+        """
+        Low priority tasks are delayed, shed or blocked when their queue is
+        past its high watermark
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['sqs_stats_cache'] = 0
+        CONFIG.options['async_high_watermark'] = 2
+        CONFIG.options['async_backpressure_timeout'] = 1
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                queue = Async.get_queue('bulk', create=True)
+                task = async_task(low_priority=True)
+
+                CONFIG.options['async_backpressure'] = 'shed'
+                self.assertEqual(Async.throttle(queue, 'bulk', task, 5), 5)
+                for _ in range(2):
+                    Async.defer(
+                        model=IRUIView,
+                        method=IRUIView.search,
+                        args=[[]],
+                        queue='bulk',
+                    )
+                self.assertRaises(
+                    QueueFull, Async.throttle, queue, 'bulk', task
+                )
+                # Other tasks are not held back
+                self.assertEqual(
+                    Async.throttle(queue, 'bulk', async_task(), 5), 5
+                )
+
+                CONFIG.options['async_backpressure'] = 'delay'
+                self.assertEqual(Async.throttle(queue, 'bulk', task), 300)
+                # FIFO queues cannot delay messages, the task is blocked
+                self.assertRaises(
+                    QueueFull, Async.apply_backpressure, 'bulk', 0, True
+                )
+
+                CONFIG.options['async_backpressure'] = 'block'
+                self.assertRaises(
+                    QueueFull, Async.throttle, queue, 'bulk', task
+                )
+        finally:
+            del CONFIG.options['sqs_stats_cache']
+            del CONFIG.options['async_high_watermark']
+            del CONFIG.options['async_backpressure_timeout']
+            del CONFIG.options['async_backpressure']
+
+    @mock_sqs
+    def test_rate_limit(self):
+        """
+        The tasks deferred beyond their rate limit are delayed to run at
+        the rate
+        """
+        Async = POOL.get('async.async')
+
+        self.assertEqual(parse_rate(2), 2.0)
+        self.assertEqual(parse_rate('120/m'), 2.0)
+        self.assertEqual(parse_rate('7200 / h'), 2.0)
+
+        bucket = TokenBucket(2, capacity=2)
+        waits = [bucket.reserve() for _ in range(5)]
+        self.assertEqual(waits[:2], [0, 0])
+        for wait, expected in zip(waits[2:], [0.5, 1, 1.5]):
+            self.assertAlmostEqual(wait, expected, places=1)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            queue = Async.get_queue(create=True)
+            task = async_task(rate_limit='1/s')
+            self.assertEqual(
+                [Async.throttle(queue, None, task) for _ in range(3)],
+                [0, 1, 2]
+            )
+
+    def test_workers_needed(self):
+        """
+        Test the estimation of the number of workers needed
+        """
+        Async = POOL.get('async.async')
+
+        stats = QueueStats('queue', 100, 20, 0, 30, 0)
+        self.assertEqual(Async.get_workers_needed(stats, 1, 60), 2)
+        self.assertEqual(Async.get_workers_needed(stats, 1, 60, 4), 1)
+        self.assertEqual(Async.get_workers_needed(stats, 2, 10), 24)
+        self.assertEqual(
+            Async.get_workers_needed(stats._replace(depth=0, in_flight=0), 1),
+            0
+        )
+
+        # 40 messages drained in 10 seconds with 20 in flight
+        later = stats._replace(depth=60, in_flight=20, timestamp=10)
+        self.assertEqual(Async.get_task_seconds(stats, later), 5)
+        self.assertEqual(Async.get_task_seconds(later, stats), None)
+        self.assertEqual(Async.get_task_seconds(stats, stats), None)
+
+    @mock_sqs
+    def test_defer_scheduled(self):
+        """
+        Tasks delayed beyond the SQS limit are scheduled and sent to the
+        queue once due
+        """
+        Async = POOL.get('async.async')
+        ScheduledTask = POOL.get('async.scheduled_task')
+        IRUIView = POOL.get('ir.ui.view')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            conn = Async.get_sqs_connection()
+
+            ids = map(int, IRUIView.search([], limit=10))
+            Async.defer(
+                model=IRUIView,
+                method=IRUIView.read,
+                args=[ids, ['name']],
+                delay_seconds=3600,
+            )
+            queue = Async.get_queue()
+            self.assertEqual(
+                len(conn.receive_message(queue, number_messages=2)), 0
+            )
+
+            task, = ScheduledTask.search([])
+            self.assertTrue(
+                task.eta > datetime.utcnow() + timedelta(seconds=3500)
+            )
+
+            # Not due yet
+            self.assertEqual(ScheduledTask.send_due(), 0)
+
+            ScheduledTask.write([task], {
+                'eta': datetime.utcnow() - timedelta(seconds=1),
+            })
+            self.assertEqual(ScheduledTask.send_due(), 1)
+            self.assertEqual(ScheduledTask.search([]), [])
+
+            message, = conn.receive_message(queue, number_messages=2)
+            result = Async.execute_task(
+                Async.deserialize_message(message.get_body())
+            )
+            self.assertEqual(result, IRUIView.read(ids, ['name']))
+
+    @mock_sqs
+    def test_chain(self):
+        """
+        Each task of a chain is sent by the worker executing the previous
+        one, with the previous result as first argument
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            conn = Async.get_sqs_connection()
+            queue = Async.get_queue(create=True)
+
+            result_async = Async.chain([
+                Async.signature('search', IRUIView, args=[[]],
+                                kwargs={'limit': 2}),
+                Async.signature('browse', IRUIView),
+            ], result_options=ResultOptions(False, 60))
+
+            message, = conn.receive_message(queue, number_messages=10)
+            views = Async.execute_task(
+                Async.deserialize_message(message.get_body())
+            )
+            message.delete()
+            self.assertEqual(len(views), 2)
+
+            # Executing the first task sent the next one
+            message, = conn.receive_message(queue, number_messages=10)
+            Async.execute_task(
+                Async.deserialize_message(message.get_body())
+            )
+            self.assertEqual(result_async.wait(), views)
+
+    @mock_sqs
+    def test_compact_envelope(self):
+        """
+        The compact envelope is smaller and decodes to the same payload,
+        and messages sent in full are still decoded
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['async_envelope'] = 'compact'
+        CONFIG.options['async_task_codes'] = 's=ir.ui.view.search'
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                payload = dict(Async.signature(
+                    'search', IRUIView, args=[[]], kwargs={'limit': 2}
+                ), database_name=DB_NAME, user=USER, context={})
+                full = Async.serialize_payload(
+                    dict(payload, __result_uuid__=None,
+                         __result_options__=[True, 60, 100])
+                )
+                compact = Async.serialize_task(dict(payload))
+                self.assertTrue(len(compact) < len(full) / 2)
+
+                envelope = Async.deserialize_message(compact)
+                self.assertEqual(envelope['k'], 's')
+                self.assertFalse('c' in envelope)
+                self.assertFalse('r' in envelope)
+                self.assertEqual(
+                    Async.deserialize_task(compact),
+                    Async.deserialize_task(full),
+                )
+                self.assertRaises(
+                    UnknownTask, Async.expand_payload,
+                    dict(envelope, k='unknown')
+                )
+
+                Async.defer(
+                    model=IRUIView, method=IRUIView.search, args=[[]],
+                    kwargs={'limit': 2},
+                )
+                message, = Async.get_queue().get_messages(1)
+                self.assertEqual(
+                    Async.execute_task(
+                        Async.deserialize_message(message.get_body())
+                    ),
+                    IRUIView.search([], limit=2)
+                )
+        finally:
+            del CONFIG.options['async_envelope']
+            del CONFIG.options['async_task_codes']
+
+    def test_task_context(self):
+        """
+        The context sent with the tasks can be restricted
+        """
+        Async = POOL.get('async.async')
+
+        context = {'language': 'en_US', 'company': 1, 'client': 'web'}
+        with Transaction().start(DB_NAME, USER, context=context):
+            self.assertEqual(Async.get_task_context(), context)
+
+            CONFIG.options['async_context_exclude'] = 'client'
+            CONFIG.options['async_context_keys'] = ''
+            try:
+                self.assertEqual(
+                    Async.get_task_context(),
+                    {'language': 'en_US', 'company': 1}
+                )
+
+                CONFIG.options['async_context_keys'] = 'language, client'
+                self.assertEqual(
+                    Async.get_task_context(), {'language': 'en_US'}
+                )
+            finally:
+                del CONFIG.options['async_context_keys']
+                del CONFIG.options['async_context_exclude']
+
+    def test_eager(self):
+        """
+        In eager mode the tasks are executed right away, without SQS, and
+        their results are available at once
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['async_eager'] = 'immediate'
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                ids = map(int, IRUIView.search([], limit=10))
+                result_async = Async.defer(
+                    model=IRUIView,
+                    method=IRUIView.read,
+                    args=[ids, ['name']],
+                    result_options=ResultOptions(False, 60),
+                )
+                self.assertEqual(
+                    result_async.wait(), IRUIView.read(ids, ['name'])
+                )
+
+                result_async = Async.chain([
+                    Async.signature('search', IRUIView, args=[[]],
+                                    kwargs={'limit': 2}),
+                    Async.signature('browse', IRUIView),
+                ], result_options=ResultOptions(False, 60))
+                self.assertEqual(
+                    result_async.wait(), IRUIView.search([], limit=2)
+                )
+        finally:
+            del CONFIG.options['async_eager']
+
+    def test_task_registry(self):
+        """
+        The decorated methods of the models are found, unless overridden
+        by a method which is not decorated
+        """
+        class Report(object):
+            __metaclass__ = PoolMeta
+            __name__ = 'report.bigreport'
+
+            @async_task(queue='reports')
+            def render(self):
+                pass
+
+            @async_task()
+            @classmethod
+            def clean(cls):
+                pass
+
+        class SyncReport(Report):
+            __name__ = 'report.syncreport'
+
+            def render(self):
+                pass
+
+        Async = POOL.get('async.async')
+
+        tasks = Async.find_tasks([Report, SyncReport])
+        self.assertEqual(sorted(tasks), [
+            'report.bigreport.clean', 'report.bigreport.render',
+            'report.syncreport.clean',
+        ])
+        self.assertEqual(tasks['report.bigreport.render'].queue, 'reports')
+
+    def test_check_task(self):
+        """
+        Deferring a task which does not exist fails
+        """
+        Async = POOL.get('async.async')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(Async.check_task('ir.ui.view', 'search'), None)
+            self.assertRaises(
+                UnknownTask, Async.check_task, 'ir.ui.view', 'unknown'
+            )
+            self.assertRaises(
+                UnknownTask, Async.defer, 'search', 'unknown.model'
+            )
+
+            CONFIG.options['async_registered_only'] = True
+            try:
+                self.assertRaises(
+                    UnknownTask, Async.check_task, 'ir.ui.view', 'search'
+                )
+            finally:
+                del CONFIG.options['async_registered_only']
+
+    def test_defer_method(self):
+        """
+        A decorated method can be deferred with its defer method, with
+        the options of its decorator
+        """
+        IRUIView = POOL.get('ir.ui.view')
+
+        class View(object):
+            __metaclass__ = PoolMeta
+            __name__ = 'ir.ui.view'
+
+            @async_task(ignore_result=False)
+            @classmethod
+            def search(cls, domain, limit=None):
+                pass
+
+        CONFIG.options['async_eager'] = 'immediate'
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                result_async = View.search.defer([], limit=2)
+                self.assertEqual(
+                    result_async.wait(), IRUIView.search([], limit=2)
+                )
+        finally:
+            del CONFIG.options['async_eager']
+
+    def test_eager_results(self):
+        """
+        Results executed by eager threads are waited for
+        """
+        Async = POOL.get('async.async')
+
+        Async._eager_results.set('uuid', [1, 2])
+        self.assertEqual(Async._eager_results.pop('uuid'), (True, [1, 2]))
+        self.assertEqual(Async._eager_results.pop('uuid', 0.1), (False, None))
+
+        # The exception of a failed task is raised to the waiter
+        Async._eager_results.set('uuid', None, ValueError('Failed'))
+        self.assertRaises(ValueError, Async._eager_results.pop, 'uuid')
+
+        # Results never fetched are dropped, the oldest first
+        results = EagerResults(size=2)
+        for result_uuid in ('a', 'b', 'c'):
+            results.set(result_uuid, result_uuid)
+        self.assertEqual(results.pop('a', 0), (False, None))
+        self.assertEqual(results.pop('c', 0), (True, 'c'))
+
+    @mock_sqs
+    def test_chord(self):
+        """
+        The callback of a chord is sent with all the results once the last
+        task is done
+        """
+        Async = POOL.get('async.async')
+        Chord = POOL.get('async.chord')
+        IRUIView = POOL.get('ir.ui.view')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            conn = Async.get_sqs_connection()
+            queue = Async.get_queue(create=True)
+
+            view1, view2 = IRUIView.search([], limit=2, order=[('id', 'ASC')])
+            result_async = Async.chord([
+                Async.signature('search_count', IRUIView, args=[
+                    [('id', '=', view.id)]
+                ])
+                for view in (view1, view2)
+            ], Async.signature('browse', IRUIView),
+                result_options=ResultOptions(False, 60))
+
+            chord, = Chord.search([])
+            self.assertEqual(chord.remaining, 2)
+
+            messages = conn.receive_message(queue, number_messages=10)
+            self.assertEqual(len(messages), 2)
+            payloads = [
+                Async.deserialize_message(message.get_body())
+                for message in messages
+            ]
+            for message in messages:
+                message.delete()
+
+            # A task delivered twice counts once
+            Async.execute_task(payloads[0])
+            Async.execute_task(payloads[0])
+            self.assertEqual(Chord(chord.id).remaining, 1)
+            Async.execute_task(payloads[1])
+            self.assertEqual(Chord.search([]), [])
+            Async.execute_task(payloads[1])
+
+            message, = conn.receive_message(queue, number_messages=10)
+            Async.execute_task(
+                Async.deserialize_message(message.get_body())
+            )
+            self.assertEqual(
+                result_async.wait(), IRUIView.browse([1, 1])
+            )
+
+    @mock_sqs
+    def test_chord_concurrent(self):
+        """
+        Two workers storing the last results of a chord at the same time
+        send the callback once
+        """
+        Async = POOL.get('async.async')
+        Chord = POOL.get('async.chord')
+        IRUIView = POOL.get('ir.ui.view')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as \
+                transaction:
+            conn = Async.get_sqs_connection()
+            queue = Async.get_queue(create=True)
+            callback, result_async = Async._with_result(
+                Async.signature('browse', IRUIView), ResultOptions(False, 60)
+            )
+            chord_id = Chord.start(2, callback)
+
+            # Take the snapshot of the first worker before the second one
+            # stores its result and commits
+            self.assertEqual(Chord(chord_id).remaining, 2)
+            with Transaction().new_cursor():
+                Chord.add_result(chord_id, 1, 2)
+                Transaction().cursor.commit()
+            try:
+                Chord.add_result(chord_id, 0, 1)
+            except DatabaseOperationalError:
+                # The count is refused on the stale snapshot, the task
+                # is executed again
+                transaction.cursor.rollback()
+                Chord.add_result(chord_id, 0, 1)
+            transaction.cursor.commit()
+            self.assertEqual(Chord.search([('id', '=', chord_id)]), [])
+
+            message, = conn.receive_message(queue, number_messages=10)
+            Async.execute_task(
+                Async.deserialize_message(message.get_body())
+            )
+            self.assertEqual(
+                result_async.wait(), IRUIView.browse([1, 2])
+            )
+
+    @mock_sqs
+    def test_stream_result(self):
+        """
+        The items of a generator task are sent in chunks and read back in
+        order
+        """
+        Async = POOL.get('async.async')
+        AsyncResult = Async._result_class
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            payload = {
+                '__result_uuid__': 'stream-result',
+                '__result_options__': ResultOptions(False, 60, 3),
+            }
+            Async.stream_to_sqs(
+                payload['__result_uuid__'], (i for i in xrange(10)), 3
+            )
+            self.assertEqual(list(AsyncResult(payload)), range(10))
+
+            # The whole result can also be waited for
+            Async.stream_to_sqs(
+                payload['__result_uuid__'], (i for i in xrange(5)), 3
+            )
+            self.assertEqual(AsyncResult(payload).wait(), range(5))
+
+            # A task failing partway does not pass for a shorter result
+            def failing():
+                for i in xrange(5):
+                    yield i
+                raise ValueError('Broken')
+            self.assertRaises(
+                ValueError, Async.stream_to_sqs,
+                payload['__result_uuid__'], failing(), 3
+            )
+            result_async = AsyncResult(payload)
+            self.assertRaises(IncompleteResult, result_async.wait, 5)
+            self.assertFalse(result_async.done)
+
+            # Chunks which stop arriving time out
+            queue = Async.get_queue(payload['__result_uuid__'], create=True)
+            Async.get_transport().send_message(
+                queue, Async.serialize_payload({'seq': 0, 'chunk': [0]})
+            )
+            result_async = AsyncResult(payload)
+            self.assertRaises(IncompleteResult, result_async.wait, 2)
+            self.assertFalse(result_async.done)
+
+    def test_result_options_compatibility(self):
+        """
+        Result options of messages sent by older versions are read
+        """
+        options = ResultOptions(*[False, 60])
+        self.assertEqual(options.chunk_size, 100)
+
+    def test_memory_result_cache(self):
+        """
+        The memory cache evicts the least recently used and expired results
+        """
+        cache = MemoryResultCache(size=2)
+
+        cache.set('a', '1', 60)
+        cache.set('b', '2', 60)
+        self.assertEqual(cache.get('a'), (True, '1'))
+
+        # b is the least recently used
+        cache.set('c', '3', 60)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, '1'))
+
+        cache.set('c', '3', -1)
+        self.assertEqual(cache.get('c'), (False, None))
+
+    def test_table_result_cache(self):
+        """
+        The table cache returns results until they expire
+        """
+        ResultCache = POOL.get('async.result_cache')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            ResultCache.set('a', '1', 60)
+            ResultCache.set('a', '2', 60)
+            self.assertEqual(ResultCache.get('a'), (True, '2'))
+
+            ResultCache.set('b', '3', -1)
+            self.assertEqual(ResultCache.get('b'), (False, None))
+
+    @mock_sqs
+    def test_defer_cached(self):
+        """
+        A cached result is returned without sending the task again
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            conn = Async.get_sqs_connection()
+            queue = Async.get_queue(create=True)
+
+            ids = map(int, IRUIView.search([], limit=10))
+            result_async = Async.defer(
+                model=IRUIView,
+                method=IRUIView.read,
+                args=[ids, ['name']],
+                result_options=ResultOptions(False, 60),
+                cache_ttl=60,
+            )
+            message, = conn.receive_message(queue, number_messages=10)
+            message.delete()
+            payload = Async.deserialize_message(message.get_body())
+            Async.execute_task(payload)
+
+            # The memory cache is filled by the client reading the result
+            key, ttl = payload['__cache__']
+            self.assertEqual(
+                Async.get_result_cache().get(key), (False, None)
+            )
+            result_async.wait()
+
+            result_async = Async.defer(
+                model=IRUIView,
+                method=IRUIView.read,
+                args=[ids, ['name']],
+                cache_ttl=60,
+            )
+            self.assertEqual(
+                conn.receive_message(queue, number_messages=10), []
+            )
+            self.assertEqual(
+                result_async.wait(), IRUIView.read(ids, ['name'])
+            )
+
+            # Other arguments are not cached
+            Async.defer(
+                model=IRUIView,
+                method=IRUIView.read,
+                args=[ids, ['model']],
+                cache_ttl=60,
+            )
+            self.assertEqual(
+                len(conn.receive_message(queue, number_messages=10)), 1
+            )
+
+        # The worker fills a shared cache even if the result is ignored
+        CONFIG.options['async_result_cache'] = 'table'
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async.defer(
+                    model=IRUIView,
+                    method=IRUIView.read,
+                    args=[ids, ['arch']],
+                    cache_ttl=60,
+                )
+                message, = conn.receive_message(queue, number_messages=10)
+                message.delete()
+                Async.execute_task(
+                    Async.deserialize_message(message.get_body())
+                )
+
+                Async.defer(
+                    model=IRUIView,
+                    method=IRUIView.read,
+                    args=[ids, ['arch']],
+                    cache_ttl=60,
+                )
+                self.assertEqual(
+                    conn.receive_message(queue, number_messages=10), []
+                )
+        finally:
+            del CONFIG.options['async_result_cache']
+
+    @mock_sqs
+    def test_defer_time_limits(self):
+        """
+        The time limits of a task are sent to the worker
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            conn = Async.get_sqs_connection()
+
+            Async.defer(
+                model=IRUIView,
+                method=IRUIView.search,
+                args=[[]],
+                time_limit=60,
+                soft_time_limit=50,
+            )
+            message, = conn.receive_message(
+                Async.get_queue(), number_messages=2
+            )
+            payload = Async.deserialize_message(message.get_body())
+            self.assertEqual(payload['__time_limits__'], [50, 60])
+
+    @mock_sqs
+    def test_trace(self):
+        """
+        The trace of the deferring transaction is carried to the task by
+        the message attributes and continued by its execution
+        """
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'trace.jsonl')
+        CONFIG.options['async_trace'] = 'file'
+        CONFIG.options['async_trace_file'] = path
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                conn = Async.get_sqs_connection()
+
+                with Async.trace('request') as request:
+                    Async.defer(
+                        model=IRUIView,
+                        method=IRUIView.search,
+                        args=[[]],
+                    )
+                message, = conn.receive_message(
+                    Async.get_queue(), number_messages=2,
+                    message_attributes=['All'],
+                )
+                trace_id, parent_id, enqueued_at = Span.extract(
+                    message.message_attributes
+                )
+                self.assertEqual(trace_id, request.trace_id)
+                self.assertTrue(enqueued_at)
+
+                with Async.trace('execute', trace_id, parent_id):
+                    Async.execute_task(
+                        Async.deserialize_task(message.get_body())
+                    )
+
+            with open(path) as spans:
+                spans = dict(
+                    (span['name'], span) for span in map(json.loads, spans)
+                )
+            self.assertEqual(
+                set(spans), set(['request', 'enqueue', 'execute'])
+            )
+            self.assertEqual(
+                set(span['trace_id'] for span in spans.values()),
+                set([request.trace_id])
+            )
+            self.assertEqual(
+                spans['enqueue']['parent_id'], spans['request']['span_id']
+            )
+            self.assertEqual(
+                spans['execute']['parent_id'], spans['enqueue']['span_id']
+            )
+            self.assertEqual(spans['enqueue']['attributes']['task'],
+                             'ir.ui.view.search')
+        finally:
+            del CONFIG.options['async_trace']
+            del CONFIG.options['async_trace_file']
+            shutil.rmtree(directory)
+
 
 def suite():
     """
@@ -0,0 +1,522 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.transport
+
+    Test the SQLite transport
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import sys
+import os
+if 'DB_NAME' not in os.environ:
+    os.environ['DB_NAME'] = ':memory:'
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import time
+import shutil
+import tempfile
+import unittest
+
+import trytond.tests.test_tryton
+from trytond import backend
+from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT, POOL
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond.modules.async_sqs import ResultOptions, async_task
+from trytond.modules.async_sqs.transport import SQLiteTransport
+from trytond.modules.async_sqs.worker import Replayer, Listener, \
+    PipelinedListener, MultiDatabaseListener
+
+
+class TestTransport(unittest.TestCase):
+    '''
+    Test the SQLite transport
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('async_sqs')
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'queue.sqlite')
+        self.transport = SQLiteTransport(self.path, poll_interval=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_queue(self):
+        '''
+        Queues are created once and can be deleted
+        '''
+        self.assertEqual(self.transport.get_queue('tasks'), None)
+        queue = self.transport.create_queue('tasks', 60)
+        self.assertEqual(queue.name, 'tasks')
+        self.assertEqual(queue.get_timeout(), 60)
+        self.assertEqual(
+            self.transport.create_queue('tasks').get_timeout(), 60
+        )
+
+        queue.delete()
+        self.assertEqual(self.transport.get_queue('tasks'), None)
+
+    def test_receive_and_delete(self):
+        '''
+        Messages are received in order, hidden while in flight and gone
+        once deleted
+        '''
+        queue = self.transport.create_queue('tasks', 60)
+        self.transport.send_message_batch(queue, [
+            (str(index), 'message %d' % index, 0, {}) for index in xrange(3)
+        ])
+        self.transport.send_message(
+            queue, 'delayed', delay_seconds=60,
+            message_attributes={'trace': 'abc'},
+        )
+
+        messages = queue.get_messages(2)
+        self.assertEqual(
+            [message.get_body() for message in messages],
+            ['message 0', 'message 1']
+        )
+        self.assertEqual(queue.get_attributes('All'), {
+            'ApproximateNumberOfMessages': '1',
+            'ApproximateNumberOfMessagesNotVisible': '2',
+            'ApproximateNumberOfMessagesDelayed': '1',
+            'VisibilityTimeout': '60',
+        })
+
+        self.transport.delete_message_batch(queue, messages)
+        message, = queue.get_messages(10)
+        self.assertEqual(message.get_body(), 'message 2')
+        message.delete()
+
+        # Nothing visible, waiting times out
+        started_at = time.time()
+        self.assertEqual(queue.get_messages(10, wait_time_seconds=1), [])
+        self.assertTrue(time.time() - started_at >= 1)
+
+    def test_visibility_timeout(self):
+        '''
+        A message not deleted within its visibility timeout is received
+        again, and the first receipt can no longer delete it
+        '''
+        queue = self.transport.create_queue('tasks', 60)
+        self.transport.send_message(queue, 'task')
+
+        first, = queue.get_messages(1, visibility_timeout=0)
+        second, = queue.get_messages(1)
+        self.assertEqual(second.attributes['ApproximateReceiveCount'], '2')
+
+        first.delete()
+        self.assertEqual(
+            queue.get_attributes()['ApproximateNumberOfMessagesNotVisible'],
+            '1'
+        )
+
+        second.change_visibility(0)
+        third, = queue.get_messages(1)
+        third.delete()
+        self.assertEqual(queue.get_messages(1), [])
+
+    def test_fifo(self):
+        '''
+        The messages of a group of a FIFO queue are received in order, one
+        batch of the group at a time, and duplicates are dropped
+        '''
+        queue = self.transport.create_queue('tasks.fifo', 60)
+        for body, group_id in [('a1', 'a'), ('b1', 'b'), ('a2', 'a')]:
+            self.transport.send_message(
+                queue, body, message_group_id=group_id,
+                message_deduplication_id=body,
+            )
+        self.transport.send_message(
+            queue, 'a1 again', message_group_id='a',
+            message_deduplication_id='a1',
+        )
+
+        a1, = queue.get_messages(1)
+        self.assertEqual(a1.get_body(), 'a1')
+        self.assertEqual(a1.attributes['MessageGroupId'], 'a')
+
+        # The group a waits for its message in flight
+        b1, = queue.get_messages(10)
+        self.assertEqual(b1.get_body(), 'b1')
+        self.assertEqual(queue.get_messages(10), [])
+
+        # A message made visible again is received before the next ones
+        a1.change_visibility(0)
+        a1, = queue.get_messages(1)
+        self.assertEqual(a1.get_body(), 'a1')
+        a1.delete()
+        a2, = queue.get_messages(10)
+        self.assertEqual(a2.get_body(), 'a2')
+
+    def test_defer(self):
+        '''
+        Tasks and results go through the SQLite queue when configured
+        '''
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                ids = map(int, IRUIView.search([], limit=10))
+                result_async = Async.defer(
+                    model=IRUIView,
+                    method=IRUIView.read,
+                    args=[ids, ['name']],
+                    result_options=ResultOptions(False, 60),
+                )
+
+                message, = Async.get_queue().get_messages(1)
+                Async.execute_task(
+                    Async.deserialize_message(message.get_body())
+                )
+                message.delete()
+
+                self.assertEqual(
+                    result_async.wait(5), IRUIView.read(ids, ['name'])
+                )
+                self.assertEqual(Async.get_queue(result_async.result_uuid),
+                                 None)
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_defer_fifo(self):
+        '''
+        Tasks sent to a FIFO queue are grouped by record
+        '''
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                view = IRUIView.search([], limit=1)[0]
+                for _ in xrange(2):
+                    Async.defer(
+                        model=IRUIView,
+                        method=IRUIView.read,
+                        args=[[view.id], ['name']],
+                        queue='records.fifo',
+                    )
+                    Async.defer(
+                        method='get_rec_name',
+                        instance=view,
+                        args=['name'],
+                        queue='records.fifo',
+                    )
+                self.assertRaises(
+                    ValueError, Async.defer,
+                    method='get_rec_name', instance=view, args=['name'],
+                    queue='records.fifo', delay_seconds=10,
+                )
+
+                queue = Async.get_queue('records.fifo')
+                messages = queue.get_messages(10)
+                self.assertEqual(
+                    [message.attributes['MessageGroupId']
+                        for message in messages],
+                    ['ir.ui.view', 'ir.ui.view,%d' % view.id] * 2
+                )
+
+                # The same call is only sent once when deduplicated
+                payload = Async.deserialize_task(messages[1].get_body())
+                self.assertEqual(
+                    Async.get_message_ids(
+                        queue, payload, async_task(deduplicate=True)
+                    ),
+                    ('ir.ui.view,%d' % view.id, Async.get_cache_key(payload))
+                )
+                self.assertEqual(
+                    Async.get_message_ids(
+                        queue, payload,
+                        async_task(message_group=lambda payload: 'views')
+                    ),
+                    ('views', None)
+                )
+                self.assertEqual(
+                    Async.get_message_ids(
+                        Async.get_queue(create=True), payload
+                    ),
+                    (None, None)
+                )
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_replay(self):
+        '''
+        The messages of a dead-letter queue passing the filters are moved
+        back to the queues of their tasks
+        '''
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                for method in ['read', 'search', 'read']:
+                    Async.defer(
+                        model=IRUIView,
+                        method=method,
+                        args=[[]],
+                        queue='dead',
+                    )
+
+            replayer = Replayer(DB_NAME, 'dead', methods=['read'],
+                                dry_run=True)
+            self.assertEqual(replayer.run(), 2)
+            self.assertEqual(replayer.skipped, 1)
+
+            replayer = Replayer(DB_NAME, 'dead', methods=['read'],
+                                reencode=True, rate=100)
+            self.assertEqual(replayer.run(), 2)
+
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                messages = Async.get_queue().get_messages(10)
+                self.assertEqual(
+                    [Async.deserialize_task(message.get_body())['method_name']
+                        for message in messages],
+                    ['read', 'read']
+                )
+                # The message filtered out is left in the dead-letter queue
+                message, = Async.get_queue('dead').get_messages(10)
+                self.assertEqual(
+                    Async.deserialize_task(message.get_body())['method_name'],
+                    'search'
+                )
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_replay_slow_drain(self):
+        '''
+        A drain slower than the visibility timeout sees every message once
+        and leaves the messages filtered out in the source queue
+        '''
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                for method in ['read'] * 2 + ['search'] * 10:
+                    Async.defer(
+                        model=IRUIView,
+                        method=method,
+                        args=[[]],
+                        queue='dead',
+                    )
+
+            # The rate limit holds the first batch for a second
+            replayer = Replayer(DB_NAME, 'dead', methods=['read'],
+                                dry_run=True, rate=1, visibility_timeout=2)
+            self.assertEqual(replayer.run(), 2)
+            self.assertEqual(replayer.skipped, 10)
+
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                self.assertEqual(
+                    len(Async.get_queue('dead').get_messages(10)), 10
+                )
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_failed_task(self):
+        '''
+        The message of a failed task is left in its queue if the queue has
+        a redrive policy
+        '''
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async.defer(
+                    model=IRUIView,
+                    method=IRUIView.search,
+                    args=[[('unknown_field', '=', 1)]],
+                    queue='failing',
+                )
+
+            listener = Listener(DB_NAME, queues=['failing'])
+            queue, = listener.get_queues()
+            message, = queue.get_messages(1)
+            self.assertFalse(listener.has_redrive_policy(queue))
+            self.assertEqual(listener.execute_message(message), True)
+
+            listener.redrive_policies[queue.name] = True
+            self.assertEqual(listener.execute_message(message), False)
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_retried_task(self):
+        '''
+        A task failing on an operational error of the database is executed
+        again in a new transaction
+        '''
+        Async = POOL.get('async.async')
+        IRUIView = POOL.get('ir.ui.view')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        executed = []
+
+        class TestListener(Listener):
+
+            def execute_task(self, payload):
+                executed.append(payload['method_name'])
+                if len(executed) == 1:
+                    raise DatabaseOperationalError('could not serialize')
+                return super(TestListener, self).execute_task(payload)
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async.defer(
+                    model=IRUIView, method=IRUIView.search_count,
+                    args=[[]], queue='retried',
+                )
+
+            listener = TestListener(DB_NAME, queues=['retried'])
+            listener.redrive_policies['retried'] = True
+            queue, = listener.get_queues()
+            message, = queue.get_messages(1)
+            self.assertEqual(listener.execute_message(message), True)
+            self.assertEqual(executed, ['search_count', 'search_count'])
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_multi_database_queues(self):
+        '''
+        The multi-database listener looks its queues up through the pool,
+        so the transport configured for the module is used
+        '''
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            listener = MultiDatabaseListener([DB_NAME], queues=['tenant'])
+            queue, = listener.get_queues(DB_NAME)
+            self.assertEqual(
+                queue.name, '%s-tenant' % DB_NAME.replace(':', '')
+            )
+            self.assertTrue(self.transport.get_queue(queue.name))
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_pipelined_listener(self):
+        '''
+        The pipelined listener receives ahead of execution into a bounded
+        buffer, extends the visibility of the messages that waited and
+        releases the buffered messages when it stops
+        '''
+        executed = []
+        buffered = []
+        visibility_changes = []
+
+        class TestListener(PipelinedListener):
+
+            def receive(self, queue, number_messages, wait_time_seconds):
+                messages = super(TestListener, self).receive(
+                    queue, number_messages, wait_time_seconds
+                )
+                for message in messages:
+                    message.change_visibility = self.spy(message)
+                return messages
+
+            def spy(self, message):
+                change_visibility = message.change_visibility
+
+                def spy(visibility_timeout):
+                    visibility_changes.append(
+                        (message.get_body(), visibility_timeout)
+                    )
+                    return change_visibility(visibility_timeout)
+                return spy
+
+            def execute_message(self, message):
+                executed.append(message.get_body())
+                # Let the receiver fill the buffer meanwhile
+                time.sleep(0.6)
+                buffered.append(self.buffer.qsize())
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            queue = self.transport.create_queue(
+                '%s-pipelined' % DB_NAME.replace(':', ''), 1
+            )
+            self.transport.send_message_batch(queue, [
+                (str(index), 'task %d' % index, 0, {})
+                for index in xrange(5)
+            ])
+
+            listener = TestListener(
+                DB_NAME, prefetch_messages=2, queues=['pipelined'],
+                max_tasks_per_worker=2,
+            )
+            listener.listen()
+
+            self.assertEqual(executed, ['task 0', 'task 1'])
+            self.assertEqual(buffered, [2, 2])
+            # The second task waited for more than half of the visibility
+            # timeout, the buffered ones were released on stop
+            self.assertEqual(visibility_changes[0], ('task 1', 1))
+            self.assertEqual(
+                sorted(visibility_changes[1:]),
+                [('task 2', 0), ('task 3', 0)]
+            )
+            self.assertEqual(
+                sorted(
+                    message.get_body() for message in queue.get_messages(10)
+                ),
+                ['task 2', 'task 3', 'task 4']
+            )
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+    def test_pipelined_listener_error(self):
+        '''
+        A failed receive stops the pipelined listener with its error
+        '''
+        class TestListener(PipelinedListener):
+
+            def receive(self, queue, number_messages, wait_time_seconds):
+                raise IOError('Connection reset')
+
+        CONFIG.options['async_transport'] = 'sqlite'
+        CONFIG.options['async_queue_path'] = self.path
+        try:
+            listener = TestListener(DB_NAME, queues=['pipelined'])
+            self.assertRaises(IOError, listener.listen)
+        finally:
+            del CONFIG.options['async_transport']
+            del CONFIG.options['async_queue_path']
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestTransport)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,499 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.worker
+
+    Test the worker helpers
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import sys
+import os
+if 'DB_NAME' not in os.environ:
+    os.environ['DB_NAME'] = ':memory:'
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+from StringIO import StringIO
+
+import trytond.tests.test_tryton
+from trytond.modules.async_sqs import SoftTimeLimitExceeded, \
+    TimeLimitExceeded
+from trytond.modules.async_sqs.worker import PrefetchController, \
+    SoftTimeLimit, raise_in_thread, must_recycle, get_rss_mb, \
+    TaskProfiler, Executor, ConcurrencyController, MultiDatabaseListener, \
+    Scheduler, Listener, get_parser
+
+
+class TestWorker(unittest.TestCase):
+    '''
+    Test the worker helpers
+    '''
+
+    def test_prefetch_grows_on_deep_queue(self):
+        '''
+        Full receives of fast tasks raise the number of messages to 10
+        '''
+        controller = PrefetchController(1, 10, visibility_timeout=30)
+
+        for count in (1, 2, 4, 8, 10):
+            self.assertEqual(controller.number_messages, count)
+            controller.record_receive(count)
+            controller.record_execution(0.1)
+        self.assertEqual(controller.number_messages, 10)
+
+        controller.record_receive(3)
+        self.assertEqual(controller.number_messages, 10)
+        self.assertEqual(controller.receives, 6)
+        self.assertEqual(controller.messages_per_receive, 28 / 6.0)
+
+    def test_prefetch_shrinks_on_slow_tasks(self):
+        '''
+        Slow tasks lower the number of messages to fit in the visibility
+        timeout
+        '''
+        controller = PrefetchController(1, 10, visibility_timeout=30)
+        controller.number_messages = 10
+
+        controller.record_execution(5)
+        self.assertEqual(controller.number_messages, 3)
+
+        controller.record_execution(60)
+        self.assertEqual(controller.number_messages, 1)
+
+    def test_prefetch_fixed(self):
+        '''
+        Without a maximum the number of messages never changes
+        '''
+        controller = PrefetchController(1, 1)
+
+        controller.record_receive(1)
+        controller.record_execution(0.01)
+        self.assertEqual(controller.number_messages, 1)
+
+    def test_prefetch_clamped(self):
+        '''
+        No more than 10 messages are received at a time, the SQS limit
+        '''
+        controller = PrefetchController(20, 50)
+        self.assertEqual(controller.number_messages, 10)
+
+        controller.record_receive(10)
+        controller.record_execution(0.01)
+        self.assertEqual(controller.number_messages, 10)
+
+    def test_idle_backoff(self):
+        '''
+        Empty receives delay the next receive, up to the maximum backoff
+        '''
+        controller = PrefetchController(1, 10, max_backoff=4)
+        self.assertTrue(controller.ready())
+
+        for backoff in (1, 2, 4, 4):
+            controller.record_receive(0)
+            self.assertEqual(controller.backoff, backoff)
+        self.assertFalse(controller.ready())
+        self.assertEqual(controller.empty_receives, 4)
+
+        controller.record_receive(1)
+        self.assertEqual(controller.backoff, 0)
+        self.assertTrue(controller.ready())
+
+    def test_soft_time_limit(self):
+        '''
+        The soft time limit raises inside a block running for too long
+        '''
+        def run_forever():
+            with SoftTimeLimit(0.1):
+                while True:
+                    time.sleep(0.01)
+
+        self.assertRaises(SoftTimeLimitExceeded, run_forever)
+
+        with SoftTimeLimit(0.1):
+            pass
+        # Leaving the block in time cancels the limit
+        time.sleep(0.2)
+
+        # A limit expiring as the block is left is not raised out of it.
+        # The pending exception is only checked every so many bytecodes.
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(10 ** 6)
+        try:
+            for _ in xrange(100):
+                pass
+            with SoftTimeLimit(10) as limit:
+                limit.expire()
+            for _ in xrange(10 ** 6):
+                pass
+        finally:
+            sys.setcheckinterval(check_interval)
+
+    def test_raise_in_thread(self):
+        '''
+        An exception can be raised in an abandoned thread
+        '''
+        outcome = []
+        running = threading.Event()
+
+        def run_forever():
+            try:
+                running.set()
+                while True:
+                    time.sleep(0.01)
+            except TimeLimitExceeded:
+                outcome.append(True)
+
+        thread = threading.Thread(target=run_forever)
+        thread.start()
+        running.wait(1)
+        raise_in_thread(thread, TimeLimitExceeded)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(outcome, [True])
+
+    def test_time_limit_commit(self):
+        '''
+        An abandoned task is rolled back even if it gets to its commit, and
+        a task which committed is not abandoned
+        '''
+        calls = []
+        finished = threading.Event()
+
+        class Cursor(object):
+            def commit(self):
+                calls.append('commit')
+
+            def rollback(self):
+                calls.append('rollback')
+
+        class Transaction(object):
+            cursor = Cursor()
+
+        class TestListener(Listener):
+            def __init__(self, seconds):
+                self.seconds = seconds
+
+            def execute_payload(self, message, payload, soft_time_limit,
+                                commit):
+                try:
+                    time.sleep(self.seconds)
+                except TimeLimitExceeded:
+                    # The task swallows the exception
+                    pass
+                try:
+                    return commit(Transaction())
+                finally:
+                    finished.set()
+
+        payload = {'model_name': 'ir.ui.view', 'method_name': 'search'}
+        self.assertEqual(TestListener(0).execute_with_time_limit(
+            None, payload, None, 1
+        ), True)
+        self.assertEqual(calls, ['commit'])
+
+        del calls[:]
+        finished.clear()
+        self.assertEqual(TestListener(0.3).execute_with_time_limit(
+            None, payload, None, 0.1
+        ), False)
+        finished.wait(1)
+        self.assertEqual(calls, ['rollback'])
+
+    def test_must_recycle(self):
+        '''
+        The worker stops after its maximum number of tasks or above its
+        memory ceiling
+        '''
+        self.assertFalse(must_recycle(1000))
+        self.assertFalse(must_recycle(99, max_tasks=100))
+        self.assertTrue(must_recycle(100, max_tasks=100))
+
+        rss_mb = get_rss_mb()
+        self.assertTrue(rss_mb > 0)
+        self.assertFalse(must_recycle(1, max_rss_mb=int(rss_mb) + 1024))
+        self.assertTrue(must_recycle(1, max_rss_mb=1))
+
+    def test_concurrency_controller(self):
+        '''
+        The concurrency grows by one per window without congestion and is
+        halved on congestion, within its bounds
+        '''
+        controller = ConcurrencyController(2, 8, window=4)
+
+        def run_window(seconds=0.1, errors=0, lock=False):
+            for index in xrange(max(4, controller.concurrency)):
+                controller.record(
+                    seconds, error=index < errors, lock=lock and not index
+                )
+            return controller.concurrency
+
+        self.assertEqual(controller.concurrency, 2)
+        self.assertEqual([run_window() for _ in xrange(8)],
+                         [3, 4, 5, 6, 7, 8, 8, 8])
+
+        # A lock error, too many errors or a latency blowing up halve it
+        self.assertEqual(run_window(lock=True), 4)
+        self.assertEqual(run_window(), 5)
+        self.assertEqual(run_window(errors=2), 2)
+        self.assertEqual(run_window(errors=1), 2)
+        self.assertEqual(run_window(), 3)
+        self.assertEqual(run_window(seconds=0.3), 2)
+
+        # The executor lets as many threads take messages
+        executor = Executor(concurrency=8, controller=controller)
+        self.assertEqual(executor.limit, 2)
+        self.assertEqual(executor.idle, 2)
+
+    def test_executor_limit(self):
+        '''
+        Submitting blocks at the limit of the concurrency controller, and
+        nothing is received while no message can be submitted
+        '''
+        running = threading.Event()
+        submitted = []
+
+        class Listener(object):
+            database_name = 'test'
+            in_flight = 0
+
+            def execute_message(self, message):
+                running.wait(5)
+
+        class Queue(object):
+            name = 'tasks'
+
+            def delete_message(self, message):
+                pass
+
+        class Message(object):
+            attributes = {}
+
+        controller = ConcurrencyController(1, 8)
+        executor = Executor(concurrency=8, controller=controller)
+        listener, queue = Listener(), Queue()
+        executor.submit(listener, queue, Message())
+        self.assertEqual(executor.idle, 0)
+
+        def submit():
+            executor.submit(listener, queue, Message())
+            submitted.append(True)
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(submitted, [])
+
+        class ReceiveQueue(Queue):
+            def get_timeout(self):
+                return 30
+
+            def get_messages(self, number_messages, **kwargs):
+                raise AssertionError('Received for a busy executor')
+
+        class TestListener(MultiDatabaseListener):
+            def get_queues(self, database_name):
+                return [ReceiveQueue()]
+
+        multi_listener = TestListener(['test'])
+        multi_listener.executor = executor
+        self.assertEqual(multi_listener.poll(), 0)
+
+        running.set()
+        thread.join(1)
+        self.assertEqual(submitted, [True])
+        executor.messages.join()
+        self.assertEqual(executor.idle, 1)
+
+    def test_executor_groups(self):
+        '''
+        The messages of a group are executed in order, the groups in
+        parallel
+        '''
+        executed = []
+
+        class Listener(object):
+            database_name = 'test'
+            in_flight = 0
+
+            def execute_message(self, message):
+                time.sleep(message.seconds)
+                executed.append(message.body)
+
+        class Queue(object):
+            name = 'tasks.fifo'
+
+            def delete_message(self, message):
+                pass
+
+        class Message(object):
+            def __init__(self, body, group_id, seconds):
+                self.body = body
+                self.attributes = {'MessageGroupId': group_id}
+                self.seconds = seconds
+
+        listener, queue = Listener(), Queue()
+        # A message waiting for its group counts against the limit
+        executor = Executor(concurrency=3)
+        executor.submit(listener, queue, Message('a1', 'a', 0.2))
+        executor.submit(listener, queue, Message('a2', 'a', 0))
+        executor.submit(listener, queue, Message('b1', 'b', 0.05))
+        executor.messages.join()
+
+        self.assertEqual(executed, ['b1', 'a1', 'a2'])
+        self.assertEqual(executor.executed, 3)
+        self.assertEqual(listener.in_flight, 0)
+        self.assertEqual(executor.groups, {})
+        self.assertEqual(executor.idle, 3)
+
+    def test_multi_database_listener(self):
+        '''
+        Every database gets a receive per round, idle queues back off, and
+        pools are only loaded for messages and evicted once idle
+        '''
+        running = threading.Event()
+
+        class Listener(object):
+            in_flight = 0
+
+            def __init__(self, database_name):
+                self.database_name = database_name
+                self.closed = False
+
+            def execute_message(self, message):
+                running.wait(5)
+
+            def close(self):
+                self.closed = True
+
+        class Queue(object):
+            def __init__(self, name, messages):
+                self.name = name
+                self.messages = messages
+                self.receives = 0
+
+            def get_timeout(self):
+                return 30
+
+            def get_messages(self, number_messages, **kwargs):
+                self.receives += 1
+                messages = self.messages[:number_messages]
+                del self.messages[:number_messages]
+                return messages
+
+            def delete_message(self, message):
+                pass
+
+        class Message(object):
+            attributes = {}
+
+        queues = {
+            'a': Queue('a', [Message() for _ in xrange(5)]),
+            'b': Queue('b', [Message()]),
+            'c': Queue('c', []),
+        }
+        created = []
+
+        class TestListener(MultiDatabaseListener):
+            def get_queues(self, database_name):
+                return [queues[database_name]]
+
+            def new_listener(self, database_name):
+                created.append(database_name)
+                return Listener(database_name)
+
+        listener = TestListener(
+            ['a', 'b', 'c'], prefetch_messages=2, concurrency=4, max_pools=1
+        )
+        self.assertEqual(listener.poll(), 3)
+        # The backlog of a does not hold b back, and no pool is loaded for
+        # the empty c
+        self.assertEqual(
+            [queues[name].receives for name in 'abc'], [1, 1, 1]
+        )
+        self.assertEqual(created, ['a', 'b'])
+        # a is kept loaded while its messages execute
+        self.assertFalse(listener.listeners['a'].closed)
+
+        running.set()
+        listener.executor.messages.join()
+
+        # c is in its idle backoff
+        self.assertEqual(listener.poll(), 2)
+        self.assertEqual(
+            [queues[name].receives for name in 'abc'], [2, 2, 1]
+        )
+
+        listener.executor.messages.join()
+        running.clear()
+        b = listener.listeners['b']
+        queues['c'].messages.append(Message())
+        listener.get_controller(queues['c']).next_receive_at = 0
+        # Loading c evicts the idle b but not a, busy with its last message
+        self.assertEqual(listener.poll(), 2)
+        self.assertEqual(created, ['a', 'b', 'c'])
+        self.assertEqual(list(listener.listeners), ['a', 'c'])
+        self.assertTrue(b.closed)
+        running.set()
+        listener.executor.messages.join()
+
+    def test_scheduler_interval(self):
+        '''
+        The scheduler runs more often than SQS can delay a message
+        '''
+        for interval in (0, 900, 3600):
+            self.assertRaises(ValueError, Scheduler, 'test', interval)
+
+    def test_task_profiler(self):
+        '''
+        The sampled tasks are profiled in a directory per task, and the
+        profiles of a task are merged in a report
+        '''
+        directory = tempfile.mkdtemp()
+        try:
+            TaskProfiler(directory).run('ir.ui.view.search', sum, [1, 2])
+            TaskProfiler(directory, rate=0).run('ir.ui.view.read', sum, [])
+            TaskProfiler(directory, threshold=60).run(
+                'ir.ui.view.write', sum, []
+            )
+            self.assertEqual(
+                TaskProfiler(directory).run('ir.ui.view.search', sum, [3]), 3
+            )
+            self.assertEqual(os.listdir(directory), ['ir.ui.view.search'])
+            self.assertEqual(
+                len(os.listdir(os.path.join(directory, 'ir.ui.view.search'))),
+                2
+            )
+
+            args = get_parser().parse_args(['profiles', directory])
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                args.func(args)
+                report = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertTrue('ir.ui.view.search: 2 profiles' in report)
+            self.assertTrue('sum' in report)
+        finally:
+            shutil.rmtree(directory)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestWorker)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
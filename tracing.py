@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.tracing
+
+    Spans of the life of the tasks, from the transaction deferring them to
+    the worker executing them and to the tasks they defer in turn.
+
+    The trace and the span of the enqueue are carried from the client to
+    the worker in the attributes of the message. Within a process the
+    current span is kept per thread, so the spans of nested calls become
+    its children.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import json
+import time
+import threading
+from uuid import uuid4
+
+__all__ = ['Span', 'NullSpan', 'FileExporter', 'get_current_span']
+
+_local = threading.local()
+
+
+def new_id():
+    return uuid4().hex[:16]
+
+
+def get_current_span():
+    """
+    Returns the span being run by the current thread or None
+    """
+    return getattr(_local, 'span', None)
+
+
+class Span(object):
+    """
+    A timed operation of a trace, exported when it ends.
+
+    The span is the current span of the thread while it runs. By default it
+    is a child of the current span, or the root of a new trace if there is
+    none.
+
+    :param exporter: Object with an `export(span)` method
+    :param trace_id: ID of the trace, for a span continuing a remote one
+    :param parent_id: ID of the parent span, for a span continuing a
+                      remote one
+    :param start: Time at which the span started, defaults to when it is
+                  entered
+    """
+    def __init__(self, exporter, name, trace_id=None, parent_id=None,
+                 start=None, **attributes):
+        current = get_current_span()
+        if trace_id is None and current is not None:
+            trace_id, parent_id = current.trace_id, current.span_id
+        self.exporter = exporter
+        self.name = name
+        self.trace_id = trace_id or new_id()
+        self.parent_id = parent_id
+        self.span_id = new_id()
+        self.start = start
+        self.end = None
+        self.attributes = attributes
+        self.previous = None
+
+    def __enter__(self):
+        if self.start is None:
+            self.start = time.time()
+        self.previous = get_current_span()
+        _local.span = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _local.span = self.previous
+        self.finish(error=type.__name__ if type else None)
+
+    def finish(self, end=None, error=None):
+        """
+        End the span and export it
+        """
+        self.end = end or time.time()
+        if error:
+            self.attributes['error'] = error
+        self.exporter.export(self)
+
+    def set(self, name, value):
+        """
+        Set an attribute of the span
+        """
+        self.attributes[name] = value
+
+    def inject(self, attributes=None):
+        """
+        Returns the message attributes with the IDs of the span added, to
+        continue the trace in the worker.
+        """
+        attributes = dict(attributes or {})
+        attributes['trace_id'] = {
+            'data_type': 'String', 'string_value': self.trace_id,
+        }
+        attributes['span_id'] = {
+            'data_type': 'String', 'string_value': self.span_id,
+        }
+        attributes['enqueued_at'] = {
+            'data_type': 'Number', 'string_value': repr(time.time()),
+        }
+        return attributes
+
+    @staticmethod
+    def extract(attributes):
+        """
+        Returns the trace ID, the span ID and the enqueue time carried by
+        the message attributes, or Nones.
+        """
+        def get(name):
+            attribute = (attributes or {}).get(name)
+            return attribute['string_value'] if attribute else None
+
+        enqueued_at = get('enqueued_at')
+        return (
+            get('trace_id'), get('span_id'),
+            float(enqueued_at) if enqueued_at else None,
+        )
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.end - self.start,
+            'attributes': self.attributes,
+        }
+
+
+class NullSpan(object):
+    """
+    A span standing in for the real ones when tracing is disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def finish(self, end=None, error=None):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def inject(self, attributes=None):
+        return attributes
+
+
+class FileExporter(object):
+    """
+    Append the spans to a file, one JSON object per line
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.as_dict()) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as spans:
+                spans.write(line)
@@ -0,0 +1,373 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.transport
+
+    A durable message queue in a local SQLite database.
+
+    It implements the part of the boto SQS connection, queue and message
+    API used by the module and the worker, so it can replace SQS on a
+    single node or in tests (`async_transport = sqlite`). The database is
+    in WAL mode, so producers and consumers of several processes do not
+    block each other.
+
+    As on SQS, the queues whose name ends with `.fifo` are FIFO queues:
+    the messages of a message group are received in order, one batch of
+    the group at a time, and messages sent again with the same
+    deduplication ID within 5 minutes are dropped.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+import json
+import time
+import sqlite3
+import threading
+from uuid import uuid4
+
+__all__ = ['SQLiteTransport', 'SQLiteQueue', 'SQLiteMessage']
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS queue ('
+    'name TEXT PRIMARY KEY, '
+    'visibility_timeout INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS message ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'queue TEXT NOT NULL, '
+    'body TEXT NOT NULL, '
+    'attributes TEXT, '
+    'sent_at REAL NOT NULL, '
+    'visible_at REAL NOT NULL, '
+    'receipt_handle TEXT, '
+    'receive_count INTEGER NOT NULL DEFAULT 0, '
+    'group_id TEXT)',
+    'CREATE INDEX IF NOT EXISTS message_visible_at '
+    'ON message (queue, visible_at)',
+    'CREATE TABLE IF NOT EXISTS deduplication ('
+    'queue TEXT NOT NULL, '
+    'id TEXT NOT NULL, '
+    'sent_at REAL NOT NULL, '
+    'PRIMARY KEY (queue, id))',
+]
+
+#: Seconds during which a deduplication ID drops the messages sent with it
+DEDUPLICATION_INTERVAL = 5 * 60
+
+# The messages of the groups with a message in flight are not received,
+# FIFO queues do not delay messages so the hidden ones are in flight
+FIFO_CONDITION = (
+    'AND (group_id IS NULL OR group_id NOT IN ('
+    'SELECT group_id FROM message WHERE queue = ? AND visible_at > ? '
+    'AND group_id IS NOT NULL)) '
+)
+
+# Connections by path, one per thread as sqlite3 requires
+_local = threading.local()
+
+
+class SQLiteTransport(object):
+    """
+    Connection to the queues stored in the SQLite database at `path`.
+
+    :param poll_interval: Seconds between two looks at an empty queue
+                          while waiting for messages
+    """
+    def __init__(self, path, poll_interval=0.1):
+        self.path = path
+        self.poll_interval = poll_interval
+
+    def connect(self):
+        """
+        Returns the connection of the current thread to the database,
+        creating the tables if required.
+        """
+        connections = _local.__dict__.setdefault('connections', {})
+        connection = connections.get(self.path)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connections[self.path] = connection
+        return connection
+
+    def execute(self, query, params=(), write=False):
+        """
+        Execute the query in its own transaction and return the rows.
+        Writes take the write lock upfront so that two receivers never
+        claim the same message.
+        """
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        try:
+            rows = connection.execute(query, params).fetchall()
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return rows
+
+    def get_queue(self, queue_name, owner_acct_id=None):
+        """
+        Returns the queue or None if it does not exist
+        """
+        rows = self.execute(
+            'SELECT visibility_timeout FROM queue WHERE name = ?',
+            (queue_name,)
+        )
+        if not rows:
+            return None
+        return SQLiteQueue(self, queue_name, rows[0][0])
+
+    def create_queue(self, queue_name, visibility_timeout=None):
+        """
+        Returns the queue, creating it if it does not exist
+        """
+        self.execute(
+            'INSERT OR IGNORE INTO queue (name, visibility_timeout) '
+            'VALUES (?, ?)', (queue_name, visibility_timeout or 30),
+            write=True
+        )
+        return self.get_queue(queue_name)
+
+    def delete_queue(self, queue):
+        """
+        Delete the queue and its messages
+        """
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute(
+            'DELETE FROM message WHERE queue = ?', (queue.name,)
+        )
+        connection.execute('DELETE FROM queue WHERE name = ?', (queue.name,))
+        connection.execute('COMMIT')
+        return True
+
+    def send_message(self, queue, message_content, delay_seconds=None,
+                     message_attributes=None, message_group_id=None,
+                     message_deduplication_id=None):
+        """
+        Add a message to the queue, visible after `delay_seconds`.
+
+        The group and deduplication IDs are those of the messages of FIFO
+        queues, which boto does not know about.
+        """
+        self.send_message_batch(queue, [
+            (
+                None, message_content, delay_seconds, message_attributes,
+                message_group_id, message_deduplication_id,
+            ),
+        ])
+
+    def send_message_batch(self, queue, messages):
+        """
+        Add the messages given as tuples of (id, body, delay_seconds,
+        message_attributes) in one transaction. The tuples may end with
+        the group and deduplication IDs of the message.
+        """
+        now = time.time()
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute(
+            'DELETE FROM deduplication WHERE sent_at < ?',
+            (now - DEDUPLICATION_INTERVAL,)
+        )
+        for message in messages:
+            _, body, delay_seconds, attributes = message[:4]
+            group_id, deduplication_id = message[4:] or (None, None)
+            if deduplication_id is not None and not connection.execute(
+                    'INSERT OR IGNORE INTO deduplication (queue, id, sent_at) '
+                    'VALUES (?, ?, ?)',
+                    (queue.name, deduplication_id, now)).rowcount:
+                continue
+            connection.execute(
+                'INSERT INTO message '
+                '(queue, body, attributes, sent_at, visible_at, group_id) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (
+                    queue.name, body,
+                    json.dumps(attributes) if attributes else None,
+                    now, now + (delay_seconds or 0), group_id,
+                )
+            )
+        connection.execute('COMMIT')
+
+    def receive_message(self, queue, number_messages=1,
+                        visibility_timeout=None, attributes=None,
+                        wait_time_seconds=None, message_attributes=None):
+        """
+        Receive up to `number_messages` visible messages, hiding them for
+        `visibility_timeout` seconds (by default the one of the queue).
+        Waits up to `wait_time_seconds` for messages when the queue is
+        empty.
+        """
+        if visibility_timeout is None:
+            visibility_timeout = queue.visibility_timeout
+        end_time = time.time() + (wait_time_seconds or 0)
+        while True:
+            messages = self.claim(queue, number_messages, visibility_timeout)
+            if messages or time.time() >= end_time:
+                return messages
+            time.sleep(self.poll_interval)
+
+    def claim(self, queue, number_messages, visibility_timeout):
+        """
+        Hide the oldest visible messages of the queue for
+        `visibility_timeout` seconds and return them
+        """
+        now = time.time()
+        connection = self.connect()
+        # Look without the write lock first, so that idle receivers polling
+        # an empty queue do not hold up the writers
+        if not connection.execute(
+                'SELECT 1 FROM message WHERE queue = ? AND visible_at <= ? '
+                'LIMIT 1', (queue.name, now)).fetchall():
+            return []
+        if queue.fifo:
+            # Messages made visible again keep their place in their group
+            query, params = FIFO_CONDITION + 'ORDER BY id', (queue.name, now)
+        else:
+            query, params = 'ORDER BY visible_at, id', ()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT id, body, attributes, sent_at, receive_count, '
+                'group_id FROM message WHERE queue = ? AND visible_at <= ? '
+                + query + ' LIMIT ?',
+                (queue.name, now) + params + (min(10, number_messages),)
+            ).fetchall()
+            messages = []
+            for id_, body, attributes, sent_at, receive_count, group_id \
+                    in rows:
+                receipt_handle = str(uuid4())
+                connection.execute(
+                    'UPDATE message SET visible_at = ?, receipt_handle = ?, '
+                    'receive_count = receive_count + 1 WHERE id = ?',
+                    (now + visibility_timeout, receipt_handle, id_)
+                )
+                messages.append(SQLiteMessage(
+                    queue, id_, body, receipt_handle,
+                    json.loads(attributes) if attributes else {},
+                    sent_at, receive_count + 1, group_id,
+                ))
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return messages
+
+    def delete_message(self, queue, message):
+        """
+        Delete the message, unless it was received again since
+        """
+        return self.delete_message_batch(queue, [message])
+
+    def delete_message_batch(self, queue, messages):
+        """
+        Delete the messages in one transaction
+        """
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(
+            'DELETE FROM message WHERE id = ? AND receipt_handle = ?',
+            [(message.id, message.receipt_handle) for message in messages]
+        )
+        connection.execute('COMMIT')
+        return True
+
+    def change_message_visibility(self, queue, receipt_handle,
+                                  visibility_timeout):
+        """
+        Hide the received message for `visibility_timeout` seconds from
+        now. 0 makes it visible right away.
+        """
+        self.execute(
+            'UPDATE message SET visible_at = ? WHERE queue = ? '
+            'AND receipt_handle = ?',
+            (time.time() + visibility_timeout, queue.name, receipt_handle),
+            write=True
+        )
+        return True
+
+    def get_queue_attributes(self, queue, attribute='All'):
+        """
+        Returns the counters of the queue, named as in SQS
+        """
+        now = time.time()
+        (visible, in_flight, delayed), = self.execute(
+            'SELECT '
+            'COALESCE(SUM(visible_at <= ?), 0), '
+            'COALESCE(SUM(visible_at > ? AND receive_count > 0), 0), '
+            'COALESCE(SUM(visible_at > ? AND receive_count = 0), 0) '
+            'FROM message WHERE queue = ?',
+            (now, now, now, queue.name)
+        )
+        return {
+            'ApproximateNumberOfMessages': str(visible),
+            'ApproximateNumberOfMessagesNotVisible': str(in_flight),
+            'ApproximateNumberOfMessagesDelayed': str(delayed),
+            'VisibilityTimeout': str(queue.visibility_timeout),
+        }
+
+
+class SQLiteQueue(object):
+    """
+    A queue of a :class:`SQLiteTransport`
+    """
+    def __init__(self, connection, name, visibility_timeout):
+        self.connection = connection
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.fifo = name.endswith('.fifo')
+
+    def get_timeout(self):
+        return self.visibility_timeout
+
+    def get_attributes(self, attributes='All'):
+        return self.connection.get_queue_attributes(self, attributes)
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     attributes=None, wait_time_seconds=None,
+                     message_attributes=None):
+        return self.connection.receive_message(
+            self, num_messages, visibility_timeout, attributes,
+            wait_time_seconds, message_attributes,
+        )
+
+    def delete_message(self, message):
+        return self.connection.delete_message(self, message)
+
+    def delete(self):
+        return self.connection.delete_queue(self)
+
+
+class SQLiteMessage(object):
+    """
+    A message received from a :class:`SQLiteQueue`
+    """
+    def __init__(self, queue, id, body, receipt_handle, message_attributes,
+                 sent_at, receive_count, group_id=None):
+        self.queue = queue
+        self.id = id
+        self.body = body
+        self.receipt_handle = receipt_handle
+        self.message_attributes = message_attributes
+        # System attributes as strings, as SQS returns them
+        self.attributes = {
+            'SentTimestamp': str(int(sent_at * 1000)),
+            'ApproximateReceiveCount': str(receive_count),
+        }
+        if group_id is not None:
+            self.attributes['MessageGroupId'] = group_id
+
+    def get_body(self):
+        return self.body
+
+    def delete(self):
+        return self.queue.delete_message(self)
+
+    def change_visibility(self, visibility_timeout):
+        return self.queue.connection.change_message_visibility(
+            self.queue, self.receipt_handle, visibility_timeout
+        )
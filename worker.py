@@ -7,20 +7,61 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
     :license: 3-clause BSD License, see COPYRIGHT for more details
 """
+import os
+import sys
+import time
+import ctypes
+import pstats
+import random
+import cProfile
+import tempfile
+import Queue
 import logging
+import calendar
+import resource
+import threading
+from datetime import datetime
+from collections import OrderedDict, defaultdict, deque
 
 from trytond import backend
 from trytond.pool import Pool
+from trytond.config import CONFIG
 from trytond.transaction import Transaction
 
+from trytond.modules.async_sqs.schedule import MAX_DELAY_SECONDS
+from trytond.modules.async_sqs.tracing import Span
+from trytond.modules.async_sqs.ratelimit import TokenBucket
+from trytond.modules.async_sqs import SoftTimeLimitExceeded, \
+    TimeLimitExceeded, UnknownTask, ResultOptions
+
 logger = logging.getLogger('AsyncSQS')
 
 
 class Listener(object):
     """
-    Listen to the task queue for a given daatabase
+    Listen to the task queues for a given daatabase
+
+    :param queues: Names of the queues to consume. Defaults to the default
+                   queue of the database.
+    :param max_prefetch_messages: Let the number of messages received at a
+                                  time grow from `prefetch_messages` up to
+                                  this when the queue is deep (see
+                                  :class:`PrefetchController`).
+    :param max_idle_backoff: Maximum seconds to pause between receives on
+                             an idle queue. 0 never pauses.
+    :param max_tasks_per_worker: Stop listening after executing this many
+                                 tasks, so that a supervisor starts a fresh
+                                 worker.
+    :param max_rss_mb: Stop listening once the resident memory of the
+                       process exceeds this many megabytes.
+    :param profiler: A :class:`TaskProfiler` to profile the tasks with
+    :param concurrency_controller: A :class:`ConcurrencyController` to
+                                   report the executions of the tasks to
     """
-    def __init__(self, database_name, prefetch_messages=1):
+    def __init__(self, database_name, prefetch_messages=1, queues=None,
+                 max_prefetch_messages=None, max_idle_backoff=0,
+                 max_tasks_per_worker=None, max_rss_mb=None, profiler=None,
+                 concurrency_controller=None):
         Database = backend.get('Database')
         self.database_name = database_name
         self.database = Database(database_name).connect()
@@ -30,30 +71,143 @@ class Listener(object):
             self.pool.init()
 
         self.prefetch_messages = prefetch_messages
+        self.queues = queues or [None]
+        self._queues = None
+        self.max_prefetch_messages = max_prefetch_messages or \
+            prefetch_messages
+        self.max_idle_backoff = max_idle_backoff
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_rss_mb = max_rss_mb
+        self.profiler = profiler
+        self.concurrency_controller = concurrency_controller
+        self.controllers = {}
+        self.redrive_policies = {}
+        self.tasks_executed = 0
 
-    def listen(self):
+        # Number of messages of this database being executed by an
+        # executor thread
+        self.in_flight = 0
+
+    def get_queues(self):
         """
-        Listen to the queue where tasks would be queued
+        Returns the SQS queues to consume, creating them if required.
         """
-        Async = self.pool.get('async.async')
+        if self._queues is None:
+            Async = self.pool.get('async.async')
 
-        with Transaction().start(self.database_name, 0, readonly=True):
-            queue = Async.get_queue()
+            with Transaction().start(self.database_name, 0, readonly=True):
+                self._queues = [
+                    Async.get_queue(name, create=True) for name in self.queues
+                ]
+        return self._queues
+
+    def get_controller(self, queue):
+        """
+        Returns the :class:`PrefetchController` of the queue
+        """
+        controller = self.controllers.get(queue.name)
+        if controller is None:
+            controller = self.controllers[queue.name] = PrefetchController(
+                self.prefetch_messages, self.max_prefetch_messages,
+                queue.get_timeout(), self.max_idle_backoff,
+            )
+        return controller
+
+    def wait_for_queues(self, queues):
+        """
+        Sleep until one of the queues is out of its idle backoff
+        """
+        next_receive_at = min(
+            self.get_controller(queue).next_receive_at for queue in queues
+        )
+        delay = next_receive_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def close(self):
+        """
+        Release the pool and the database connections of the database
+        """
+        logger.info('Releasing pool of %s' % self.database_name)
+        Pool.stop(self.database_name)
+        self.database.close()
+
+    def listen(self):
+        """
+        Listen to the queues where tasks would be queued.
+
+        The queues are polled in turn so that a busy queue does not starve
+        the others. The long polling time is split between the queues.
+
+        Returns once a recycling limit is reached, the messages received
+        but not executed yet being made visible again.
+        """
+        queues = self.get_queues()
+        wait_time_seconds = max(1, 20 // len(queues))
 
         while True:
-            logger.info('Liseting to queue for new messages.')
-            messages = queue.get_messages(
-                self.prefetch_messages,
-                wait_time_seconds=20
-            )
-            logger.info('Received %d messages.' % len(messages))
-            for message in messages:
-                self.execute_message(message)
-                queue.delete_message(message)
+            for queue in queues:
+                controller = self.get_controller(queue)
+                if not controller.ready():
+                    continue
+                messages = self.receive(
+                    queue, controller.number_messages, wait_time_seconds
+                )
+                for index, message in enumerate(messages):
+                    started_at = time.time()
+                    if self.execute_message(message) is not False:
+                        queue.delete_message(message)
+                    controller.record_execution(time.time() - started_at)
+                    if self.task_done():
+                        release_messages(messages[index + 1:])
+                        return
+            self.wait_for_queues(queues)
+
+    def task_done(self):
+        """
+        Count an executed task and returns True if the worker should stop
+        to be replaced by a fresh one.
+        """
+        self.tasks_executed += 1
+        return must_recycle(
+            self.tasks_executed, self.max_tasks_per_worker, self.max_rss_mb
+        )
+
+    def receive(self, queue, number_messages, wait_time_seconds):
+        """
+        Receive up to `number_messages` messages from the queue
+        """
+        logger.info('Liseting to queue %s for new messages.' % queue.name)
+        messages = queue.get_messages(
+            number_messages,
+            wait_time_seconds=wait_time_seconds,
+            message_attributes=['All'],
+        )
+        logger.info('Received %d messages.' % len(messages))
+
+        controller = self.get_controller(queue)
+        controller.record_receive(len(messages))
+        logger.debug(
+            'Queue %s: %d receives, %d empty, %.2f messages per receive, '
+            '%.3fs per task.' % (
+                queue.name, controller.receives, controller.empty_receives,
+                controller.messages_per_receive,
+                controller.execution_time or 0,
+            )
+        )
+        return messages
 
     def execute_message(self, message):
         """
-        Execute the task by calling the async model
+        Execute the task by calling the async model.
+
+        Unknown tasks and task codes (see :meth:`Async.check_task`) are
+        rejected before a transaction is started for them.
+
+        Returns False if the task failed and its queue has a redrive
+        policy. The message is then left in the queue, so that SQS delivers
+        it again and moves it to the dead-letter queue once it failed too
+        often. Other messages are to be deleted.
         """
         Async = self.pool.get('async.async')
 
@@ -61,8 +215,152 @@ class Listener(object):
             # Serializing the payload on a readonly transaction
             # without any context to get the user, database and context
             # on which the transaction should really be executed.
-            payload = Async.deserialize_message(message.get_body())
-            assert payload['database_name'] == self.database_name
+            try:
+                payload = Async.deserialize_task(message.get_body())
+                assert payload['database_name'] == self.database_name
+                task = Async.check_task(
+                    payload['model_name'], payload['method_name']
+                )
+            except UnknownTask, exc:
+                logger.error('Rejecting message: %s' % exc)
+                return True
+
+        soft_time_limit, time_limit = payload.get(
+            '__time_limits__', [None, None]
+        )
+        if task is not None:
+            soft_time_limit = soft_time_limit or task.soft_time_limit
+            time_limit = time_limit or task.time_limit
+        if time_limit:
+            succeeded = self.execute_with_time_limit(
+                message, payload, soft_time_limit, time_limit
+            )
+        else:
+            succeeded = self.execute_payload(
+                message, payload, soft_time_limit
+            )
+        if not succeeded and self.has_redrive_policy(message.queue):
+            logger.info('Leaving the message of the failed task in %s.' %
+                        message.queue.name)
+            return False
+        return True
+
+    def has_redrive_policy(self, queue):
+        """
+        Returns whether SQS moves the messages of the queue received too
+        many times to a dead-letter queue
+        """
+        if queue.name not in self.redrive_policies:
+            self.redrive_policies[queue.name] = \
+                'RedrivePolicy' in queue.get_attributes('RedrivePolicy')
+        return self.redrive_policies[queue.name]
+
+    def execute_with_time_limit(self, message, payload, soft_time_limit,
+                                time_limit):
+        """
+        Execute the task in a thread and abandon it if it runs for more
+        than time_limit seconds. :class:`TimeLimitExceeded` is raised in
+        the abandoned thread, so that its transaction is rolled back as
+        soon as it runs Python code again.
+
+        Whether to abandon the task or let it commit is decided under one
+        lock: the thread marks the task done under it just before the
+        commit, and rolls the task back instead if it was abandoned. So a
+        committed task is never abandoned, and an abandoned task never
+        commits. A task which fails is marked done the same way once its
+        transaction is rolled back, clearing any exception raised meanwhile.
+
+        Returns whether the task succeeded.
+        """
+        outcome = {}
+        lock = threading.Lock()
+
+        def commit(transaction):
+            with lock:
+                if 'abandoned' in outcome:
+                    transaction.cursor.rollback()
+                    return False
+                transaction.cursor.commit()
+                outcome['done'] = True
+                return True
+
+        def target():
+            try:
+                outcome['succeeded'] = self.execute_payload(
+                    message, payload, soft_time_limit, commit
+                )
+                with lock:
+                    clear_in_thread(thread)
+                    outcome['done'] = True
+            except TimeLimitExceeded:
+                # Raised as the task was done, its transaction is over
+                pass
+
+        thread = threading.Thread(target=target, name='AsyncTask')
+        thread.daemon = True
+        thread.start()
+        thread.join(time_limit)
+        with lock:
+            abandoned = thread.is_alive() and 'done' not in outcome
+            if abandoned:
+                outcome['abandoned'] = True
+                logger.error(
+                    'Task %s.%s exceeded its time limit of %s seconds, '
+                    'abandoning it.' % (
+                        payload['model_name'], payload['method_name'],
+                        time_limit
+                    )
+                )
+                raise_in_thread(thread, TimeLimitExceeded)
+        if abandoned:
+            return False
+        thread.join()
+        return outcome.get('succeeded', False)
+
+    def execute_payload(self, message, payload, soft_time_limit=None,
+                        commit=None):
+        """
+        Execute the task of the message in the transaction it asks for,
+        raising :class:`SoftTimeLimitExceeded` in the task if it runs for
+        more than soft_time_limit seconds. Returns whether the task
+        succeeded.
+
+        The transaction of a successful task is passed to `commit`, if
+        given, instead of being committed. It returns whether it committed
+        the transaction.
+
+        Like the dispatcher of trytond, a task failing on an operational
+        error of the database (a lock timeout, a deadlock or a
+        serialization failure) is executed again in a new transaction, up
+        to the `retry` option of the configuration times.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        started_at = time.time()
+        retries = int(CONFIG['retry'])
+        with self.trace_message(message, payload) as span:
+            exc = self.execute_transaction(
+                message, payload, soft_time_limit, commit
+            )
+            while isinstance(exc, DatabaseOperationalError) and retries:
+                retries -= 1
+                logger.info('Retrying the task after %s' % exc)
+                exc = self.execute_transaction(
+                    message, payload, soft_time_limit, commit
+                )
+            if exc is not None:
+                span.set('error', exc.__class__.__name__)
+        self.record_execution(started_at, exc)
+        return exc is None
+
+    def execute_transaction(self, message, payload, soft_time_limit=None,
+                            commit=None):
+        """
+        Execute the task of the message once in a new transaction and
+        return the exception it failed with, if any (see
+        :meth:`execute_payload`).
+        """
+        Async = self.pool.get('async.async')
 
         with Transaction().start(
                 self.database_name,
@@ -70,40 +368,1547 @@ class Listener(object):
                 context=payload['context']) as transaction:
             # Deserialize the message again because active records live
             # within the same transaction.
-            payload = Async.deserialize_message(message.get_body())
+            payload = Async.deserialize_task(message.get_body())
             try:
                 logger.debug("Message body: %s" % payload)
-                result = Async.execute_task(payload)
+                with SoftTimeLimit(soft_time_limit):
+                    result = self.execute_task(payload)
             except Exception, exc:
                 logger.error("Transaction Rollback due to failure")
                 logger.error(exc)
                 transaction.cursor.rollback()
+                return exc
             else:
                 logger.debug("Task Succesful")
                 logger.debug(result)
-                transaction.cursor.commit()
-                return result
+                if commit is None:
+                    transaction.cursor.commit()
+                elif not commit(transaction):
+                    logger.error("Transaction Rollback of abandoned task")
+                    return TimeLimitExceeded()
 
+    def record_execution(self, started_at, exc=None):
+        """
+        Report the latency and the outcome of a task to the concurrency
+        controller if any. Operational errors of the database are lock
+        timeouts, deadlocks or serialization failures.
+        """
+        if self.concurrency_controller is None:
+            return
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        self.concurrency_controller.record(
+            time.time() - started_at, error=exc is not None,
+            lock=isinstance(exc, DatabaseOperationalError),
+        )
 
-if __name__ == '__main__':
-    from trytond.config import CONFIG
+    def trace_message(self, message, payload):
+        """
+        Record the time the message waited in its queue and return the span
+        of its execution, both continuing the trace of the transaction
+        which deferred the task. The tasks deferred by the task become
+        children of the execution.
+        """
+        Async = self.pool.get('async.async')
+
+        task_name = '%s.%s' % (payload['model_name'], payload['method_name'])
+        trace_id, parent_id, enqueued_at = Span.extract(
+            getattr(message, 'message_attributes', None)
+        )
+        if enqueued_at is not None:
+            Async.trace(
+                'queue_wait', trace_id, parent_id, start=enqueued_at,
+                task=task_name,
+            ).finish()
+        return Async.trace('execute', trace_id, parent_id, task=task_name)
+
+    def execute_task(self, payload):
+        """
+        Execute the task of the payload, under the profiler if any
+        """
+        Async = self.pool.get('async.async')
+
+        if self.profiler is None:
+            return Async.execute_task(payload)
+        return self.profiler.run(
+            '%s.%s' % (payload['model_name'], payload['method_name']),
+            Async.execute_task, payload
+        )
+
+
+class TaskProfiler(object):
+    """
+    Profile a fraction of the tasks with cProfile and write the profiles
+    in a directory per task (`model.method`), to be merged by the
+    `profiles` command of the worker.
+
+    :param directory: Directory where the profiles are written
+    :param rate: Fraction of the tasks profiled
+    :param threshold: Only write the profiles of the tasks which took more
+                      than this many seconds
+    """
+    def __init__(self, directory, rate=1.0, threshold=None):
+        self.directory = directory
+        self.rate = rate
+        self.threshold = threshold
+
+    def run(self, task_name, function, *args):
+        """
+        Call the function of the task, profiling it if it is sampled
+        """
+        if random.random() >= self.rate:
+            return function(*args)
+
+        profile = cProfile.Profile()
+        started_at = time.time()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            seconds = time.time() - started_at
+            if self.threshold is None or seconds >= self.threshold:
+                self.dump(task_name, profile, seconds)
+
+    def dump(self, task_name, profile, seconds):
+        """
+        Write the profile of the task
+        """
+        directory = os.path.join(self.directory, task_name)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another worker meanwhile
+                pass
+        fd, path = tempfile.mkstemp(
+            suffix='.prof', dir=directory,
+            prefix='%d-%dms-' % (time.time(), seconds * 1000),
+        )
+        os.close(fd)
+        profile.dump_stats(path)
+        logger.info('Profile of %s written to %s' % (task_name, path))
+
+
+def must_recycle(tasks_executed, max_tasks=None, max_rss_mb=None):
+    """
+    Returns True if the worker executed `max_tasks` tasks or its resident
+    memory exceeds `max_rss_mb` megabytes.
+    """
+    if max_tasks and tasks_executed >= max_tasks:
+        logger.info(
+            'Executed %d tasks, stopping the worker.' % tasks_executed
+        )
+        return True
+    if max_rss_mb:
+        rss_mb = get_rss_mb()
+        if rss_mb > max_rss_mb:
+            logger.info(
+                'Resident memory of %.0f MB exceeds %d MB, stopping the '
+                'worker.' % (rss_mb, max_rss_mb)
+            )
+            return True
+    return False
+
+
+def get_rss_mb():
+    """
+    Returns the resident memory of the process in megabytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / 1024.0 / 1024.0
+    except IOError:
+        # Without procfs fall back on the peak resident memory, which
+        # getrusage gives in kilobytes (bytes on OS X)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            rss /= 1024.0
+        return rss / 1024.0
+
+
+def release_messages(messages):
+    """
+    Make received messages visible again so that another worker executes
+    them right away.
+    """
+    for message in messages:
+        message.change_visibility(0)
+
+
+def raise_in_thread(thread, exception_class):
+    """
+    Raise the exception in the thread the next time it runs Python code
+    """
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread.ident), ctypes.py_object(exception_class)
+    )
+
+
+def clear_in_thread(thread):
+    """
+    Clear the exception raised in the thread by :func:`raise_in_thread` if
+    the thread did not run Python code since
+    """
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(thread.ident), None
+    )
+
+
+class SoftTimeLimit(object):
+    """
+    Context manager raising :class:`SoftTimeLimitExceeded` in the current
+    thread if it is still in the block after `seconds`.
+
+    If the limit expires as the block is left, the exception is cleared
+    before it is raised out of the block.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.thread = threading.current_thread()
+        self.lock = threading.Lock()
+        self.timer = None
+        self.exited = False
+        self.expired = False
+
+    def __enter__(self):
+        if self.seconds:
+            self.timer = threading.Timer(self.seconds, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with self.lock:
+            self.exited = True
+            if self.expired:
+                clear_in_thread(self.thread)
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def expire(self):
+        with self.lock:
+            if self.exited:
+                return
+            logger.warning(
+                'Task exceeded its soft time limit of %s seconds.' %
+                self.seconds
+            )
+            self.expired = True
+            raise_in_thread(self.thread, SoftTimeLimitExceeded)
+
+
+class PipelinedListener(Listener):
+    """
+    A listener that receives messages in a background thread while the
+    tasks are being executed, so that the execution never waits on a round
+    trip to SQS.
+
+    The received messages wait in a local buffer of at most `buffer_size`
+    messages. A message that waited for more than half of the visibility
+    timeout of its queue gets its visibility timeout extended before it is
+    executed, so that it is not delivered to another worker meanwhile.
+
+    If a receive fails, the receiver thread stops and the error is raised
+    by :meth:`listen` once the buffered messages are executed, so that the
+    worker exits to be restarted by its supervisor.
+
+    :param buffer_size: Number of messages received ahead of execution.
+                        Defaults to `prefetch_messages`.
+    """
+    def __init__(self, database_name, prefetch_messages=1, queues=None,
+                 max_prefetch_messages=None, max_idle_backoff=0,
+                 max_tasks_per_worker=None, max_rss_mb=None, profiler=None,
+                 buffer_size=None):
+        super(PipelinedListener, self).__init__(
+            database_name, prefetch_messages, queues,
+            max_prefetch_messages, max_idle_backoff,
+            max_tasks_per_worker, max_rss_mb, profiler,
+        )
+        self.buffer_size = buffer_size or prefetch_messages
+        self.buffer = Queue.Queue(maxsize=self.buffer_size)
+        self.stopping = False
+        # Information on the exception which stopped the receiver thread
+        self.receiver_error = None
+
+    def listen(self):
+        """
+        Start the receiver thread and execute the messages it buffers,
+        until a recycling limit is reached.
+        """
+        for queue in self.get_queues():
+            self.get_controller(queue)
+        receiver = threading.Thread(
+            target=self.run_receiver, name='AsyncReceiver'
+        )
+        receiver.daemon = True
+        receiver.start()
+
+        while True:
+            queue, message, received_at = self.next_message(receiver)
+            controller = self.get_controller(queue)
+            timeout = controller.visibility_timeout
+            started_at = time.time()
+            if started_at - received_at > timeout / 2.0:
+                logger.info('Extending visibility of buffered message.')
+                message.change_visibility(timeout)
+            if self.execute_message(message) is not False:
+                queue.delete_message(message)
+            controller.record_execution(time.time() - started_at)
+            if self.task_done():
+                break
+        self.stop(receiver)
+
+    def stop(self, receiver):
+        """
+        Stop the receiver thread and make the buffered messages visible
+        again. The receiver finishes its current receive first, so the
+        messages it gets are released too.
+        """
+        self.stopping = True
+        self.release_buffer()
+        receiver.join()
+        self.release_buffer()
+
+    def release_buffer(self):
+        """
+        Empty the buffer, making its messages visible again
+        """
+        messages = []
+        while True:
+            try:
+                queue, message, received_at = self.buffer.get_nowait()
+            except Queue.Empty:
+                break
+            messages.append(message)
+        release_messages(messages)
+
+    def next_message(self, receiver):
+        """
+        Returns the next buffered message, raising the error of the
+        receiver thread if it stopped
+        """
+        while True:
+            try:
+                return self.buffer.get(timeout=1)
+            except Queue.Empty:
+                if receiver.is_alive():
+                    continue
+                if self.receiver_error is None:
+                    raise RuntimeError('The receiver thread stopped')
+                type_, value, traceback = self.receiver_error
+                raise type_, value, traceback
+
+    def run_receiver(self):
+        """
+        Fill the buffer until the listener stops, keeping the error which
+        stops the receiver if any
+        """
+        try:
+            self.fill_buffer()
+        except Exception:
+            logger.exception('Receiver thread failed.')
+            self.receiver_error = sys.exc_info()
+
+    def fill_buffer(self):
+        """
+        Keep the buffer filled with messages from the queues.
+
+        No more messages are received than there is room left in the
+        buffer, so received messages never wait for a slot.
+        """
+        queues = self.get_queues()
+        wait_time_seconds = max(1, 20 // len(queues))
+
+        while not self.stopping:
+            for queue in queues:
+                controller = self.get_controller(queue)
+                if not controller.ready():
+                    continue
+                room = self.buffer_size - self.buffer.qsize()
+                if room <= 0:
+                    # Wait for the executor to take a message
+                    time.sleep(0.1)
+                    continue
+                messages = self.receive(
+                    queue, min(controller.number_messages, room),
+                    wait_time_seconds
+                )
+                for message in messages:
+                    self.buffer.put((queue, message, time.time()))
+            self.wait_for_queues(queues)
+
+
+class PrefetchController(object):
+    """
+    Adapts the number of messages received at a time from a queue and the
+    pause between receives, and counts the receives.
+
+    The number of messages grows from `minimum` towards `maximum` while
+    receives come back full, which means that the queue is deep. It is
+    capped so that a batch, executed one message after the other, takes no
+    more than half of the visibility timeout. So it shrinks when the tasks
+    get slow. Neither bound exceeds 10, the most messages SQS returns per
+    receive.
+
+    After an empty receive the next one is delayed, the delay doubling on
+    every empty receive up to `max_backoff` seconds.
+
+    :param visibility_timeout: Visibility timeout of the queue in seconds
+    """
+    #: Weight of the last execution in the average execution time
+    smoothing = 0.2
+
+    def __init__(self, minimum=1, maximum=10, visibility_timeout=30,
+                 max_backoff=0):
+        self.minimum = min(10, minimum)
+        self.maximum = min(10, max(self.minimum, maximum))
+        self.visibility_timeout = visibility_timeout
+        self.max_backoff = max_backoff
+
+        self.number_messages = self.minimum
+        self.backoff = 0
+        self.next_receive_at = 0
+        self.execution_time = None
+
+        self.receives = 0
+        self.empty_receives = 0
+        self.messages = 0
+
+    @property
+    def messages_per_receive(self):
+        """
+        Average number of messages received per call to SQS
+        """
+        if not self.receives:
+            return 0.0
+        return float(self.messages) / self.receives
+
+    @property
+    def limit(self):
+        """
+        Largest number of messages that can be executed within half of the
+        visibility timeout
+        """
+        if not self.execution_time:
+            return self.maximum
+        limit = int(self.visibility_timeout / 2.0 / self.execution_time)
+        return max(self.minimum, min(self.maximum, limit))
+
+    def ready(self):
+        """
+        Returns True if the queue is not in its idle backoff
+        """
+        return time.time() >= self.next_receive_at
+
+    def record_receive(self, count):
+        """
+        Record that `count` messages were received
+        """
+        self.receives += 1
+        self.messages += count
+
+        if count:
+            self.backoff = 0
+            self.next_receive_at = 0
+            if count >= self.number_messages:
+                self.number_messages *= 2
+        else:
+            self.empty_receives += 1
+            if self.max_backoff:
+                self.backoff = min(self.max_backoff, self.backoff * 2 or 1)
+                self.next_receive_at = time.time() + self.backoff
+        self.number_messages = min(self.number_messages, self.limit)
+
+    def record_execution(self, seconds):
+        """
+        Record the time taken by the execution of a message
+        """
+        if self.execution_time is None:
+            self.execution_time = seconds
+        else:
+            self.execution_time += self.smoothing * (
+                seconds - self.execution_time
+            )
+        self.number_messages = min(self.number_messages, self.limit)
+
+
+class ConcurrencyController(object):
+    """
+    Adapts the number of tasks executed at the same time, the way TCP
+    adapts its window: additive increase, multiplicative decrease.
+
+    The executions are observed in windows of at least `window` tasks.
+    After a window without congestion the concurrency grows by one up to
+    `maximum`. After a window with congestion it is halved, down to
+    `minimum`. A window is congested if a task hit a lock of the database,
+    if more than `max_error_rate` of its tasks failed, or if their average
+    latency exceeds `latency_factor` times the best one observed, which
+    means that the added tasks only wait on each other in the database.
+
+    The best latency drifts up a little on every window, so that a slower
+    mix of tasks is not taken for congestion forever.
+    """
+    #: Factor applied to the concurrency on congestion
+    decrease_factor = 0.5
+
+    #: Fraction by which the best latency drifts up on every window
+    drift = 0.05
+
+    def __init__(self, minimum=1, maximum=10, window=10, max_error_rate=0.1,
+                 latency_factor=2.0):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+
+        self.concurrency = minimum
+        self.best_latency = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.tasks = 0
+        self.errors = 0
+        self.lock_errors = 0
+        self.seconds = 0.0
+
+    def record(self, seconds, error=False, lock=False):
+        """
+        Record the execution of a task, adapting the concurrency at the end
+        of a window
+        """
+        with self.lock:
+            self.tasks += 1
+            self.seconds += seconds
+            self.errors += bool(error)
+            self.lock_errors += bool(lock)
+            if self.tasks >= max(self.window, self.concurrency):
+                self.update()
+
+    def update(self):
+        latency = self.seconds / self.tasks
+        if self.best_latency is None:
+            self.best_latency = latency
+        else:
+            self.best_latency = min(
+                latency, self.best_latency * (1 + self.drift)
+            )
+
+        concurrency = self.concurrency
+        if self.congested(latency):
+            self.concurrency = max(
+                self.minimum, int(concurrency * self.decrease_factor)
+            )
+        else:
+            self.concurrency = min(self.maximum, concurrency + 1)
+        if self.concurrency != concurrency:
+            logger.info(
+                'Concurrency %d -> %d (%d tasks, %d errors, %d lock errors, '
+                '%.3fs per task).' % (
+                    concurrency, self.concurrency, self.tasks, self.errors,
+                    self.lock_errors, latency,
+                )
+            )
+        self.reset()
+
+    def congested(self, latency):
+        """
+        Returns True if the last window shows congestion
+        """
+        return bool(
+            self.lock_errors
+            or self.errors > self.max_error_rate * self.tasks
+            or latency > self.latency_factor * self.best_latency
+        )
+
+
+class Executor(object):
+    """
+    A fixed number of threads executing the messages submitted to it.
+
+    Submitting blocks while as many messages as the current limit (see
+    :attr:`limit`) are submitted and not executed yet, so the messages
+    received never outnumber the messages executed at the same time.
+
+    The messages of a message group of a FIFO queue are executed one after
+    the other in the order they were submitted, by the thread executing
+    the first of them. So the groups are executed in parallel, but each one
+    in order.
+
+    With a :class:`ConcurrencyController` only as many threads as it allows
+    take messages, the others wait.
+
+    :param concurrency: Number of threads executing messages
+    :param controller: A :class:`ConcurrencyController` adapting the number
+                       of messages executed at the same time, up to
+                       `concurrency`
+    """
+    def __init__(self, concurrency=1, controller=None):
+        self.concurrency = concurrency
+        self.controller = controller
+        self.messages = Queue.Queue()
+        self.lock = threading.Lock()
+        self.executed = 0
+
+        # Threads allowed to take messages, and messages submitted but not
+        # executed yet
+        self.slots = threading.Condition()
+        self.active = 0
+        self.pending = 0
+
+        # Messages waiting for the message of their group being executed,
+        # by (database, queue, group)
+        self.groups = {}
+
+        self.threads = []
+        for index in xrange(concurrency):
+            thread = threading.Thread(
+                target=self.run, name='AsyncExecutor-%d' % index
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def idle(self):
+        """
+        Number of messages that can be submitted without blocking
+        """
+        return self.limit - self.pending
+
+    @property
+    def limit(self):
+        """
+        Number of messages executed at the same time
+        """
+        if self.controller is None:
+            return self.concurrency
+        return self.controller.concurrency
+
+    def submit(self, listener, queue, message):
+        """
+        Execute the message with the listener and delete it from the queue
+        once done. Blocks until the message can be submitted without
+        exceeding the limit.
+        """
+        with self.slots:
+            while self.pending >= self.limit:
+                self.slots.wait()
+            self.pending += 1
+
+        group_id = message.attributes.get('MessageGroupId')
+        group = None
+        with self.lock:
+            listener.in_flight += 1
+            if group_id is not None:
+                group = (listener.database_name, queue.name, group_id)
+                if group in self.groups:
+                    self.groups[group].append((listener, queue, message))
+                    return
+                self.groups[group] = deque()
+        self.messages.put((listener, queue, message, group))
+
+    def wait_idle(self):
+        """
+        Wait until a message can be submitted without blocking
+        """
+        with self.slots:
+            while self.pending >= self.limit:
+                self.slots.wait()
+
+    def run(self):
+        while True:
+            self.acquire()
+            try:
+                listener, queue, message, group = self.messages.get()
+                try:
+                    while message is not None:
+                        self.execute(listener, queue, message)
+                        listener, queue, message = self.next_in_group(group)
+                finally:
+                    self.messages.task_done()
+            finally:
+                self.release()
+
+    def acquire(self):
+        """
+        Wait until the thread is allowed to take a message
+        """
+        with self.slots:
+            while self.active >= self.limit:
+                self.slots.wait()
+            self.active += 1
+
+    def release(self):
+        # The limit only changes as tasks complete, so it is checked again
+        # by all the waiting threads
+        with self.slots:
+            self.active -= 1
+            self.slots.notify_all()
+
+    def execute(self, listener, queue, message):
+        try:
+            if listener.execute_message(message) is not False:
+                queue.delete_message(message)
+        except Exception:
+            logger.exception('Failed to execute message')
+        finally:
+            with self.lock:
+                listener.in_flight -= 1
+                self.executed += 1
+            with self.slots:
+                self.pending -= 1
+                self.slots.notify_all()
+
+    def next_in_group(self, group):
+        """
+        Returns the listener, queue and message of the next message of the
+        group, or Nones once the group is done
+        """
+        if group is None:
+            return None, None, None
+        with self.lock:
+            waiting = self.groups[group]
+            if not waiting:
+                del self.groups[group]
+                return None, None, None
+            return waiting.popleft()
+
+
+class MultiDatabaseListener(object):
+    """
+    Listen to the task queues of several databases from one process.
+
+    The databases are polled in turn and each receive is limited to the
+    number of messages the executor can still take, so a busy database
+    cannot hold the threads while the queues of the others fill up. An
+    empty queue is not polled again for a while, the pause doubling on
+    every empty receive up to `max_idle_backoff` seconds, so that idle
+    databases cost few requests.
+
+    The queues are looked up with the Async model of the pool of the first
+    database, loaded once at startup, so that its overrides of the
+    transport apply. The databases are expected to have the same modules
+    installed. Other pools are only loaded once a message of their
+    database arrives, and the pools of at most `max_pools` databases are
+    kept initialized, the least recently used idle one being released when
+    another database has to be loaded.
+
+    :param database_names: Names of the databases to serve
+    :param concurrency: Number of tasks executed at the same time, shared
+                        by all the databases
+    :param max_pools: Number of database pools to keep initialized
+    :param idle_sleep: Seconds to sleep when no database had a message and
+                       no queue is in its idle backoff
+    :param max_idle_backoff: Maximum seconds to pause between receives on
+                             an idle queue. 0 never pauses.
+    :param max_tasks_per_worker: Stop listening after executing this many
+                                 tasks, all databases together.
+    :param max_rss_mb: Stop listening once the resident memory of the
+                       process exceeds this many megabytes.
+    :param profiler: A :class:`TaskProfiler` to profile the tasks with
+    :param min_concurrency: Let the number of tasks executed at the same
+                            time adapt between this and `concurrency` (see
+                            :class:`ConcurrencyController`)
+    """
+    def __init__(self, database_names, prefetch_messages=1, queues=None,
+                 concurrency=1, max_pools=10, idle_sleep=1,
+                 max_tasks_per_worker=None, max_rss_mb=None, profiler=None,
+                 min_concurrency=None, max_idle_backoff=30):
+        self.database_names = database_names
+        self.prefetch_messages = prefetch_messages
+        self.queues = queues
+        self.max_pools = max_pools
+        self.idle_sleep = idle_sleep
+        self.max_idle_backoff = max_idle_backoff
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_rss_mb = max_rss_mb
+        self.profiler = profiler
+
+        self.controller = None
+        if min_concurrency and min_concurrency < concurrency:
+            self.controller = ConcurrencyController(
+                min_concurrency, concurrency
+            )
+
+        self.listeners = OrderedDict()
+        self.executor = Executor(concurrency, self.controller)
+
+        # Queues of the databases and their PrefetchController by queue name
+        self.database_queues = {}
+        self.controllers = {}
+        self.async_model = None
+
+    def get_async_model(self):
+        """
+        Returns the Async model of the pool of the first database, loading
+        the pool the first time
+        """
+        if self.async_model is None:
+            self.async_model = load_pool(self.database_names[0]).get(
+                'async.async'
+            )
+        return self.async_model
+
+    def get_queues(self, database_name):
+        """
+        Returns the queues of the database, creating them if required. They
+        are looked up once, without the pool of the database which may not
+        be loaded.
+        """
+        queues = self.database_queues.get(database_name)
+        if queues is None:
+            Async = self.get_async_model()
+            queues = self.database_queues[database_name] = [
+                Async.get_queue(name, create=True, database_name=database_name)
+                for name in self.queues or [None]
+            ]
+        return queues
+
+    def get_controller(self, queue):
+        """
+        Returns the :class:`PrefetchController` of the queue, which keeps
+        its idle backoff
+        """
+        controller = self.controllers.get(queue.name)
+        if controller is None:
+            controller = self.controllers[queue.name] = PrefetchController(
+                self.prefetch_messages, self.prefetch_messages,
+                queue.get_timeout(), self.max_idle_backoff,
+            )
+        return controller
+
+    def get_listener(self, database_name):
+        """
+        Returns the listener of the database, initializing its pool if it
+        is not already loaded.
+        """
+        listener = self.listeners.pop(database_name, None)
+        if listener is None:
+            self.evict(self.max_pools - 1)
+            listener = self.new_listener(database_name)
+        # Mark it as the most recently used
+        self.listeners[database_name] = listener
+        return listener
+
+    def new_listener(self, database_name):
+        return Listener(
+            database_name, self.prefetch_messages, self.queues,
+            profiler=self.profiler,
+            concurrency_controller=self.controller,
+        )
+
+    def evict(self, size):
+        """
+        Release the least recently used pools until at most `size` are
+        left. Databases with messages being executed are never released.
+        """
+        for database_name in list(self.listeners):
+            if len(self.listeners) <= size:
+                break
+            listener = self.listeners[database_name]
+            if listener.in_flight:
+                continue
+            del self.listeners[database_name]
+            listener.close()
+
+    def listen(self):
+        """
+        Poll the queues of every database in turn and hand the received
+        messages to the executor.
+
+        Once a recycling limit is reached, returns when the messages
+        submitted are executed.
+        """
+        while not must_recycle(self.executor.executed,
+                               self.max_tasks_per_worker, self.max_rss_mb):
+            self.executor.wait_idle()
+            if not self.poll():
+                self.wait()
+        self.executor.messages.join()
+
+    def poll(self):
+        """
+        Receive from the queues of every database in turn, but those in
+        their idle backoff, and submit the messages to the executor.
+        Nothing is received once the executor has as many messages as its
+        limit. Returns the number of messages received.
+        """
+        received = 0
+        for database_name in self.database_names:
+            for queue in self.get_queues(database_name):
+                controller = self.get_controller(queue)
+                idle = self.executor.idle
+                if idle <= 0 or not controller.ready():
+                    continue
+                number_messages = min(self.prefetch_messages, idle)
+                messages = queue.get_messages(
+                    number_messages, wait_time_seconds=0,
+                    attributes='MessageGroupId',
+                    message_attributes=['All'],
+                )
+                controller.record_receive(len(messages))
+                if not messages:
+                    continue
+                received += len(messages)
+                listener = self.get_listener(database_name)
+                for message in messages:
+                    self.executor.submit(listener, queue, message)
+        return received
+
+    def wait(self):
+        """
+        Sleep until a queue is out of its idle backoff, or for `idle_sleep`
+        seconds if none is in backoff
+        """
+        next_receive_at = min(
+            controller.next_receive_at
+            for controller in self.controllers.itervalues()
+        )
+        delay = next_receive_at - time.time()
+        time.sleep(delay if delay > 0 else self.idle_sleep)
+
+
+class Scheduler(object):
+    """
+    Move the tasks scheduled beyond the SQS delay limit into their queues
+    as they come due.
+
+    Run a single scheduler per database, as schedulers do not coordinate.
+
+    :param interval: Seconds to sleep when no more tasks are due. Less
+                     than the SQS delay limit, as the tasks due before the
+                     next run are sent with a delay.
+    :param batch_size: Number of tasks sent per transaction
+    """
+    def __init__(self, database_name, interval=60, batch_size=100):
+        if not 0 < interval < MAX_DELAY_SECONDS:
+            raise ValueError(
+                'The interval must be between 0 and %d seconds' %
+                MAX_DELAY_SECONDS
+            )
+        self.database_name = database_name
+        self.pool = load_pool(database_name)
+        self.interval = interval
+        self.batch_size = batch_size
+
+    def send_due(self):
+        """
+        Send a batch of due tasks. Returns the number of tasks sent.
+        """
+        ScheduledTask = self.pool.get('async.scheduled_task')
+
+        with Transaction().start(self.database_name, 0) as transaction:
+            try:
+                count = ScheduledTask.send_due(
+                    self.batch_size,
+                    # Tasks due before the next run must be sent now
+                    horizon=MAX_DELAY_SECONDS - self.interval,
+                )
+            except Exception:
+                logger.exception('Failed to send scheduled tasks')
+                transaction.cursor.rollback()
+                return 0
+            transaction.cursor.commit()
+        if count:
+            logger.info('Sent %d scheduled tasks.' % count)
+        return count
+
+
+class Replayer(object):
+    """
+    Move the messages of a queue, such as the dead-letter queue of the
+    tasks, back to the queues of their tasks.
+
+    The source queue is drained in batches of 10 messages until a receive
+    returns no message. The messages left in the source queue, filtered
+    out or not sent, are hidden for `visibility_timeout` seconds, extended
+    as long as the drain goes on, so that they are not received again, and
+    are made visible again once it is drained.
+
+    :param source: Name of the queue drained
+    :param destination: Name of the queue the messages are sent to.
+                        Defaults to the route of each task (see
+                        :meth:`Async.get_route`).
+    :param models: Only replay the tasks of these models
+    :param methods: Only replay the tasks of these methods
+    :param since: Only replay the messages sent from this UTC datetime
+    :param until: Only replay the messages sent before this UTC datetime
+    :param reencode: Serialize the tasks again, in the current envelope
+    :param rate: Messages sent per second at most
+    :param limit: Number of messages replayed at most
+    :param dry_run: Count the messages to replay but leave them
+    :param visibility_timeout: Seconds the received messages are hidden
+                               for, between two extensions
+    """
+    def __init__(self, database_name, source, destination=None, models=None,
+                 methods=None, since=None, until=None, reencode=False,
+                 rate=None, limit=None, dry_run=False, visibility_timeout=600):
+        Database = backend.get('Database')
+        self.database_name = database_name
+        Database(database_name).connect()
+        self.pool = Pool(database_name)
+        if 'model' not in self.pool._pool:
+            self.pool.init()
+
+        self.source = source
+        self.destination = destination
+        self.models = models
+        self.methods = methods
+        self.since = since and calendar.timegm(since.utctimetuple())
+        self.until = until and calendar.timegm(until.utctimetuple())
+        self.reencode = reencode
+        self.bucket = rate and TokenBucket(rate, capacity=min(10, rate))
+        self.limit = limit
+        self.dry_run = dry_run
+        # Longer than a receive waits, or the messages left would be
+        # received again by every receive
+        self.visibility_timeout = max(2, visibility_timeout)
+
+        self.replayed = 0
+        self.skipped = 0
+        # Received messages staying in the source queue, by id
+        self.left = OrderedDict()
+        self.extended_at = None
+
+    def run(self):
+        """
+        Drain the source queue. Returns the number of messages replayed.
+        """
+        Async = self.pool.get('async.async')
+
+        self.transport = Async.get_transport()
+        with Transaction().start(self.database_name, 0, readonly=True):
+            source = Async.get_queue(self.source)
+        if source is None:
+            logger.error('Queue %s does not exist.' % self.source)
+            return 0
+
+        seen = set()
+        self.extended_at = time.time()
+        while self.limit is None or self.replayed < self.limit:
+            self.extend_left()
+            received = self.transport.receive_message(
+                source, number_messages=10, wait_time_seconds=1,
+                visibility_timeout=self.visibility_timeout,
+                attributes='All', message_attributes=['All'],
+            )
+            if not received:
+                break
+            messages = []
+            for message in received:
+                if message.id not in seen:
+                    messages.append(message)
+                elif message.id in self.left:
+                    # Only the latest receipt handle is valid
+                    self.left[message.id] = message
+            seen.update(message.id for message in messages)
+            if self.limit is not None:
+                room = self.limit - self.replayed
+                self.leave(messages[room:])
+                messages = messages[:room]
+            with Transaction().start(self.database_name, 0, readonly=True):
+                self.replay_messages(source, messages)
+        release_messages(self.left.values())
+        return self.replayed
+
+    def leave(self, messages):
+        """
+        Keep the messages in the source queue
+        """
+        for message in messages:
+            self.left[message.id] = message
+
+    def extend_left(self):
+        """
+        Extend the visibility timeout of the messages left before half of
+        it has passed, as the drain may take longer
+        """
+        if time.time() - self.extended_at < self.visibility_timeout / 2.0:
+            return
+        for message in self.left.values():
+            message.change_visibility(self.visibility_timeout)
+        self.extended_at = time.time()
+
+    def replay_messages(self, source, messages):
+        """
+        Send the messages passing the filters to their queues and delete
+        them from the source queue
+        """
+        Async = self.pool.get('async.async')
+
+        entries = defaultdict(list)
+        for message in messages:
+            try:
+                payload = Async.deserialize_task(message.get_body())
+            except Exception:
+                logger.exception('Skipping unreadable message %s' % message.id)
+                payload = None
+            if payload is None or not self.matches(message, payload):
+                self.skipped += 1
+                self.leave([message])
+                continue
+            body = message.get_body()
+            if self.reencode:
+                options = payload.get('__result_options__')
+                body = Async.serialize_task(
+                    payload, options and ResultOptions(*options)
+                )
+            queue_name = self.destination or Async.get_route(
+                payload['model_name'], payload['method_name']
+            )
+            entries[queue_name].append((message, body, payload))
+
+        for queue_name, queue_entries in entries.iteritems():
+            if self.bucket:
+                time.sleep(max(self.bucket.reserve() for _ in queue_entries))
+            if self.dry_run:
+                self.replayed += len(queue_entries)
+                self.leave(message for message, _, _ in queue_entries)
+                continue
+            sent = self.send(Async.get_queue(queue_name, create=True),
+                             queue_entries)
+            if sent:
+                self.transport.delete_message_batch(source, sent)
+            self.replayed += len(sent)
+
+    def matches(self, message, payload):
+        """
+        Returns True if the message passes the filters
+        """
+        if self.models and payload['model_name'] not in self.models:
+            return False
+        if self.methods and payload['method_name'] not in self.methods:
+            return False
+        sent_at = float(message.attributes.get('SentTimestamp', 0)) / 1000
+        if self.since and sent_at < self.since:
+            return False
+        if self.until and sent_at >= self.until:
+            return False
+        return True
+
+    def send(self, queue, entries):
+        """
+        Send the entries to the queue in one batch and returns the messages
+        sent
+        """
+        Async = self.pool.get('async.async')
+
+        if queue.name.endswith('.fifo'):
+            # Batches cannot carry the message groups with boto
+            for message, body, payload in entries:
+                Async.send_fifo_message(
+                    queue, body, message.message_attributes or None,
+                    message.attributes.get('MessageGroupId')
+                    or Async.get_record_group(payload),
+                    str(message.id),
+                )
+            return [message for message, _, _ in entries]
+
+        results = self.transport.send_message_batch(queue, [
+            (str(index), body, 0, message.message_attributes or {})
+            for index, (message, body, _) in enumerate(entries)
+        ])
+        failed = set(
+            int(error['id']) for error in getattr(results, 'errors', [])
+        )
+        for index in sorted(failed):
+            logger.error('Failed to replay message %s' % entries[index][0].id)
+            self.leave([entries[index][0]])
+        return [
+            message for index, (message, _, _) in enumerate(entries)
+            if index not in failed
+        ]
+
+
+def load_pool(database_name):
+    """
+    Returns the pool of the database, initializing it if required.
+    """
+    Database = backend.get('Database')
+    Database(database_name).connect()
+    pool = Pool(database_name)
+    pool.init()
+    return pool
+
+
+def listen(args):
+    """
+    Execute the tasks of the databases
+    """
+    profiler = None
+    if args.profile_dir:
+        profiler = TaskProfiler(
+            args.profile_dir, args.profile_rate, args.profile_threshold
+        )
+
+    if len(args.databases) > 1 or args.concurrency > 1:
+        listener = MultiDatabaseListener(
+            args.databases, args.prefetch_messages, args.queues,
+            concurrency=args.concurrency, max_pools=args.max_pools,
+            max_tasks_per_worker=args.max_tasks_per_worker,
+            max_rss_mb=args.max_rss_mb, profiler=profiler,
+            min_concurrency=args.min_concurrency,
+            max_idle_backoff=(
+                30 if args.max_idle_backoff is None
+                else args.max_idle_backoff
+            ),
+        )
+    elif args.buffer_size:
+        listener = PipelinedListener(
+            args.databases[0], args.prefetch_messages, args.queues,
+            args.max_prefetch_messages, args.max_idle_backoff or 0,
+            args.max_tasks_per_worker, args.max_rss_mb, profiler,
+            buffer_size=args.buffer_size,
+        )
+    else:
+        listener = Listener(
+            args.databases[0], args.prefetch_messages, args.queues,
+            args.max_prefetch_messages, args.max_idle_backoff or 0,
+            args.max_tasks_per_worker, args.max_rss_mb, profiler,
+        )
+    listener.listen()
+    logger.info('Worker stopped, it should be restarted by its supervisor.')
+
+
+def stats(args):
+    """
+    Print the statistics of the queues of the databases.
+
+    The execution time of the tasks is estimated from how fast the backlog
+    drains between two intervals, `--task-seconds` being used until then.
+    """
+    previous_stats = {}
+    task_seconds = {}
+    while True:
+        for database_name in args.databases:
+            Async = load_pool(database_name).get('async.async')
+            with Transaction().start(database_name, 0, readonly=True):
+                for name in args.queues or [None]:
+                    queue_stats = Async.get_queue_stats(
+                        name, sample_age=args.sample_age
+                    )
+                    if queue_stats is None:
+                        continue
+                    key = (database_name, name)
+                    if key in previous_stats:
+                        task_seconds[key] = Async.get_task_seconds(
+                            previous_stats[key], queue_stats
+                        ) or task_seconds.get(key)
+                    previous_stats[key] = queue_stats
+                    print(
+                        '%s %s depth=%d in_flight=%d delayed=%d '
+                        'oldest_age=%.0f workers_needed=%d' % (
+                            database_name, queue_stats.name,
+                            queue_stats.depth, queue_stats.in_flight,
+                            queue_stats.delayed, queue_stats.oldest_age,
+                            Async.get_workers_needed(
+                                queue_stats,
+                                task_seconds.get(key) or args.task_seconds,
+                                args.target_age, args.concurrency,
+                            ),
+                        )
+                    )
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+def schedule(args):
+    """
+    Send the scheduled tasks of the databases as they come due
+    """
+    schedulers = [
+        Scheduler(database_name, args.interval, args.batch_size)
+        for database_name in args.databases
+    ]
+    while True:
+        sent = [scheduler.send_due() for scheduler in schedulers]
+        if max(sent) < args.batch_size:
+            time.sleep(args.interval)
+
+
+def replay(args):
+    """
+    Move the messages of a queue back to the queues of their tasks
+    """
+    for database_name in args.databases:
+        replayer = Replayer(
+            database_name, args.source, args.destination,
+            models=args.models, methods=args.methods,
+            since=args.since, until=args.until, reencode=args.reencode,
+            rate=args.rate, limit=args.limit, dry_run=args.dry_run,
+            visibility_timeout=args.visibility_timeout,
+        )
+        replayer.run()
+        print(
+            '%s: %d messages %s, %d skipped' % (
+                database_name, replayer.replayed,
+                'to replay' if args.dry_run else 'replayed',
+                replayer.skipped,
+            )
+        )
+
+
+def parse_datetime(value):
+    """
+    Returns the UTC datetime given as `YYYY-MM-DD` or `YYYY-MM-DD HH:MM`
+    """
+    for format_ in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format_)
+        except ValueError:
+            continue
+    raise ValueError(value)
+
+
+def profiles(args):
+    """
+    Print the profiles of each task merged, written by the workers
+    """
+    for task_name in sorted(os.listdir(args.directory)):
+        if args.tasks and task_name not in args.tasks:
+            continue
+        directory = os.path.join(args.directory, task_name)
+        paths = [
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.endswith('.prof')
+        ]
+        if not paths:
+            continue
+        print('%s: %d profiles' % (task_name, len(paths)))
+        stats = pstats.Stats(*paths, stream=sys.stdout)
+        stats.sort_stats(args.sort).print_stats(args.limit)
+
+
+def get_parser():
     import argparse
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        'databases', metavar='database', nargs='+',
+        help="Name of the database (several can be given)"
+    )
+    common.add_argument(
+        '--config', dest='config',
+        help="Path to tryton config"
+    )
+    common.add_argument(
+        '--queue', dest='queues', action='append',
+        help="Name of a queue (can be repeated). "
+        "Defaults to the default queue."
+    )
+    common.add_argument(
+        '--concurrency', dest='concurrency', type=int, default=1,
+        help="Number of tasks executed at the same time. The tasks of a "
+        "message group of a FIFO queue are executed in order"
+    )
+
     parser = argparse.ArgumentParser(
         description='Simple Worker for Trytond Async SQS'
     )
-    parser.add_argument('database', help="Name of the database")
-    parser.add_argument(
+    subparsers = parser.add_subparsers(dest='command')
+
+    listen_parser = subparsers.add_parser(
+        'listen', parents=[common],
+        help="Execute tasks (the default command)"
+    )
+    listen_parser.set_defaults(func=listen)
+    listen_parser.add_argument(
+        '--prefetch', dest='prefetch_messages', type=int, default=1,
+        help="Number of messages received at a time (1-10)"
+    )
+    listen_parser.add_argument(
+        '--max-prefetch', dest='max_prefetch_messages', type=int,
+        help="Let the number of messages received at a time grow up to "
+        "this (1-10) on deep queues"
+    )
+    listen_parser.add_argument(
+        '--idle-backoff', dest='max_idle_backoff', type=int,
+        help="Maximum seconds to pause between receives on an idle queue. "
+        "Defaults to 0, or 30 for a worker with several databases or "
+        "a --concurrency"
+    )
+    listen_parser.add_argument(
+        '--buffer-size', dest='buffer_size', type=int, default=0,
+        help="Receive up to this many messages in the background while "
+        "tasks execute"
+    )
+    listen_parser.add_argument(
+        '--min-concurrency', dest='min_concurrency', type=int,
+        help="Let the number of tasks executed at the same time adapt "
+        "between this and --concurrency to the latency and errors of the "
+        "tasks"
+    )
+    listen_parser.add_argument(
+        '--max-pools', dest='max_pools', type=int, default=10,
+        help="Number of database pools kept loaded when serving "
+        "several databases"
+    )
+    listen_parser.add_argument(
+        '--max-tasks-per-worker', dest='max_tasks_per_worker', type=int,
+        help="Exit after executing this many tasks"
+    )
+    listen_parser.add_argument(
+        '--max-rss', dest='max_rss_mb', type=int,
+        help="Exit once the resident memory exceeds this many megabytes"
+    )
+    listen_parser.add_argument(
+        '--profile-dir', dest='profile_dir',
+        help="Profile the tasks and write the profiles in this directory"
+    )
+    listen_parser.add_argument(
+        '--profile-rate', dest='profile_rate', type=float, default=1.0,
+        help="Fraction of the tasks profiled (0-1)"
+    )
+    listen_parser.add_argument(
+        '--profile-threshold', dest='profile_threshold', type=float,
+        help="Only keep the profiles of tasks slower than this many seconds"
+    )
+
+    stats_parser = subparsers.add_parser(
+        'stats', parents=[common],
+        help="Print the backlog of the queues"
+    )
+    stats_parser.set_defaults(func=stats)
+    stats_parser.add_argument(
+        '--task-seconds', dest='task_seconds', type=float, default=1,
+        help="Average execution time of a task, until it is estimated "
+        "from the backlog drained between two intervals"
+    )
+    stats_parser.add_argument(
+        '--sample-age', dest='sample_age', action='store_true',
+        help="Sample the age of the oldest message. This counts as a "
+        "receive of the sampled messages towards the redrive policy"
+    )
+    stats_parser.add_argument(
+        '--target-age', dest='target_age', type=float, default=60,
+        help="Seconds in which the backlog should be executed"
+    )
+    stats_parser.add_argument(
+        '--interval', dest='interval', type=float, default=0,
+        help="Print the statistics every this many seconds"
+    )
+    schedule_parser = subparsers.add_parser(
+        'schedule', parents=[common],
+        help="Send the tasks scheduled beyond 900 seconds as they come due"
+    )
+    schedule_parser.set_defaults(func=schedule)
+    schedule_parser.add_argument(
+        '--interval', dest='interval', type=int, default=60,
+        help="Seconds between checks for due tasks (less than 900)"
+    )
+    schedule_parser.add_argument(
+        '--batch-size', dest='batch_size', type=int, default=100,
+        help="Number of tasks sent per transaction"
+    )
+
+    replay_parser = subparsers.add_parser(
+        'replay', help="Move the messages of a queue, such as a dead-letter "
+        "queue, back to the queues of their tasks"
+    )
+    replay_parser.set_defaults(func=replay)
+    replay_parser.add_argument(
+        'databases', metavar='database', nargs='+',
+        help="Name of the database (several can be given)"
+    )
+    replay_parser.add_argument(
         '--config', dest='config',
         help="Path to tryton config"
     )
-    args = parser.parse_args()
+    replay_parser.add_argument(
+        '--from', dest='source', required=True,
+        help="Name of the queue drained"
+    )
+    replay_parser.add_argument(
+        '--to', dest='destination',
+        help="Name of the queue the messages are sent to. Defaults to the "
+        "queue each task is routed to"
+    )
+    replay_parser.add_argument(
+        '--model', dest='models', action='append',
+        help="Only replay the tasks of this model (can be repeated)"
+    )
+    replay_parser.add_argument(
+        '--method', dest='methods', action='append',
+        help="Only replay the tasks of this method (can be repeated)"
+    )
+    replay_parser.add_argument(
+        '--since', dest='since', type=parse_datetime,
+        help="Only replay the messages sent from this UTC time "
+        "(YYYY-MM-DD [HH:MM])"
+    )
+    replay_parser.add_argument(
+        '--until', dest='until', type=parse_datetime,
+        help="Only replay the messages sent before this UTC time "
+        "(YYYY-MM-DD [HH:MM])"
+    )
+    replay_parser.add_argument(
+        '--reencode', dest='reencode', action='store_true',
+        help="Serialize the tasks again, in the current envelope"
+    )
+    replay_parser.add_argument(
+        '--rate', dest='rate', type=float,
+        help="Messages sent per second at most"
+    )
+    replay_parser.add_argument(
+        '--limit', dest='limit', type=int,
+        help="Number of messages replayed at most, per database"
+    )
+    replay_parser.add_argument(
+        '--dry-run', dest='dry_run', action='store_true',
+        help="Count the messages to replay without moving them"
+    )
+    replay_parser.add_argument(
+        '--visibility-timeout', dest='visibility_timeout', type=int,
+        default=600,
+        help="Seconds the messages left in the source queue are hidden "
+        "for, extended while the queue is drained (Default: 600)"
+    )
 
-    if args.config:
+    profiles_parser = subparsers.add_parser(
+        'profiles', help="Print the merged profiles of the tasks"
+    )
+    profiles_parser.set_defaults(func=profiles)
+    profiles_parser.add_argument(
+        'directory', help="Directory of the profiles"
+    )
+    profiles_parser.add_argument(
+        '--task', dest='tasks', action='append',
+        help="Only this task, as model.method (can be repeated)"
+    )
+    profiles_parser.add_argument(
+        '--sort', dest='sort', default='cumulative',
+        help="Sort key of the report (see pstats)"
+    )
+    profiles_parser.add_argument(
+        '--limit', dest='limit', type=int, default=30,
+        help="Number of functions printed per task"
+    )
+
+    parser.commands = subparsers.choices
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] not in parser.commands \
+            and argv[0] not in ('-h', '--help'):
+        # Listening is the default command
+        argv = ['listen'] + argv
+    args = parser.parse_args(argv)
+
+    if getattr(args, 'config', None):
         CONFIG.update_etc(args.config)
 
     logging.basicConfig()
-    logger.setLevel(logging.DEBUG)
-    logger.debug('Hello')
+    logger.setLevel(
+        logging.WARNING if args.command in ('stats', 'profiles', 'replay')
+        else logging.DEBUG
+    )
+    args.func(args)
 
-    listener = Listener(args.database)
-    listener.listen()
+
+if __name__ == '__main__':
+    main()
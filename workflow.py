@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async_sqs.workflow
+
+    Fan-in of the tasks of a chord.
+
+    The workers executing the tasks of a chord store their results and
+    count the ones stored. The worker storing the last one sends the
+    callback with all the results.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) LTD
+    :license: 3-clause BSD License, see COPYRIGHT for more details
+"""
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['Chord', 'ChordResult']
+
+
+class Chord(ModelSQL):
+    """
+    Tasks of a chord waiting for the others to be done
+    """
+    __name__ = 'async.chord'
+
+    size = fields.Integer('Tasks', required=True)
+    done = fields.Integer('Done Tasks', required=True)
+    remaining = fields.Function(
+        fields.Integer('Remaining Tasks'), 'get_remaining'
+    )
+    callback = fields.Text('Callback', required=True)
+    results = fields.One2Many('async.chord.result', 'chord', 'Results')
+
+    @staticmethod
+    def default_done():
+        return 0
+
+    def get_remaining(self, name):
+        return self.size - self.done
+
+    @classmethod
+    def start(cls, size, callback):
+        """
+        Start a chord of `size` tasks and return its id.
+
+        The chord is committed in its own transaction, as its tasks may be
+        executed before the current transaction ends.
+        """
+        Async = Pool().get('async.async')
+
+        with Transaction().new_cursor():
+            chord, = cls.create([{
+                'size': size,
+                'callback': Async.serialize_payload(callback),
+            }])
+            Transaction().cursor.commit()
+        return chord.id
+
+    @classmethod
+    def add_result(cls, chord_id, index, result):
+        """
+        Store the result of the task at `index` and send the callback if
+        it was the last task of the chord.
+
+        The result is stored in the transaction of the task, so it only
+        counts once the task is committed. The tasks are counted by updating
+        the row of the chord: the update waits for a concurrent worker
+        counting the same chord, and if that worker commits, the database
+        refuses the update with an operational error instead of counting on
+        a stale snapshot, so the task is executed again. A message
+        delivered again stores nothing: its position is already stored, or
+        the chord is already done.
+        """
+        pool = Pool()
+        Async = pool.get('async.async')
+        ChordResult = pool.get('async.chord.result')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        chords = cls.search([('id', '=', chord_id)])
+        if not chords:
+            return
+        chord, = chords
+        if ChordResult.search([
+                    ('chord', '=', chord.id),
+                    ('position', '=', index),
+                    ], limit=1):
+            return
+        ChordResult.create([{
+            'chord': chord.id,
+            'position': index,
+            'result': Async.serialize_payload(result),
+        }])
+        cursor.execute(*table.update(
+            columns=[table.done], values=[table.done + 1],
+            where=table.id == chord.id
+        ))
+        cursor.execute(*table.select(
+            table.done, table.size, where=table.id == chord.id
+        ))
+        done, size = cursor.fetchone()
+        if done >= size:
+            cls.execute_callback(chord)
+            cls.delete([chord])
+
+    @classmethod
+    def execute_callback(cls, chord):
+        """
+        Send the callback of the chord with the list of results of its tasks
+        """
+        Async = Pool().get('async.async')
+
+        results = [
+            Async.deserialize_message(result.result)
+            for result in sorted(chord.results, key=lambda r: r.position)
+        ]
+        callback = Async.deserialize_message(chord.callback)
+        callback['args'] = [results] + list(callback['args'])
+        Async.defer_signature(
+            callback, result_options=callback.get('__result_options__')
+        )
+
+
+class ChordResult(ModelSQL):
+    """
+    Result of a task of a chord
+    """
+    __name__ = 'async.chord.result'
+
+    chord = fields.Many2One(
+        'async.chord', 'Chord', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    position = fields.Integer('Position', required=True)
+    result = fields.Text('Result')
+
+    @classmethod
+    def __setup__(cls):
+        super(ChordResult, cls).__setup__()
+        cls._sql_constraints += [
+            ('chord_position_uniq', 'UNIQUE(chord, position)',
+                'A task of a chord can only have one result.'),
+        ]